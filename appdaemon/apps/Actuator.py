@@ -0,0 +1,154 @@
+import time
+
+###############
+# Idempotent, coalesced switching of HA devices
+###############
+
+# One OctopusAnalysis run can change several entities in quick succession, and each of those can
+#   make a switching app decide what its device should be doing.  Calling turn_on or turn_off every
+#   time is wasteful, and for cloud-controlled devices like the Tesla charger each call is slow and
+#   rate-limited.  A SwitchActuator sits in front of a switch: requests made within DEBOUNCE_SECONDS
+#   of each other are coalesced into one, and a service call is only made if the switch isn't
+#   already in the requested state.
+#
+# An app switching many devices uses a SwitchBatch instead, which keeps the same state for each
+#   switch, but has one debounce timer for all of them, and then switches everything that needs
+#   changing together, with at most one turn_on and one turn_off service call between them.
+DEBOUNCE_SECONDS = 1
+
+# After a command has been sent, HA may take a few seconds to report the new state of a cloud
+#   device.  Within this time a repeat of the same command is suppressed, even though the observed
+#   state hasn't caught up yet.
+SETTLE_SECONDS = 60
+
+
+class SwitchActuator:
+
+
+    def __init__(self, app, entity, debounce = DEBOUNCE_SECONDS):
+
+        self.app = app
+        self.entity = entity
+        self.debounce = debounce
+
+        self.desired = None             # state most recently requested
+        self.commanded = None           # state most recently sent to HA
+        self.commanded_at = 0           # time.monotonic() at which it was sent
+        self.pending = None             # handle of the debounce timer, if one is running
+
+        # Counters of service calls actually sent, and of requests that didn't need one
+        self.calls_sent = 0
+        self.calls_suppressed = 0
+
+        # Keep track of the state reported by HA, so it never needs reading back
+        self.observed = app.get_state(entity)
+        self.observed_at = time.monotonic()
+        app.listen_state(self.StateChanged, entity)
+
+
+    def StateChanged(self, entity, attribute, old, new, kwargs):
+        self.observed = new
+        self.observed_at = time.monotonic()
+
+
+    def Request(self, state):
+
+        # Ask for the switch to be "on" or "off".  Returns immediately; the switch is set once no
+        #   further requests have arrived for the debounce period, and the last request wins.
+        if self.pending is not None:
+            self.calls_suppressed = self.calls_suppressed + 1
+            self.app.cancel_timer(self.pending)
+        self.desired = state
+        self.pending = self.app.run_in(self.Actuate, self.debounce)
+
+
+    def Actuate(self, kwargs):
+
+        self.pending = None
+        state = self.desired
+        if not self.Needed(state):
+            return
+
+        if state == "on":
+            self.app.turn_on(self.entity)
+        else:
+            self.app.turn_off(self.entity)
+        self.Sent(state)
+
+
+    def Needed(self, state):
+
+        # Whether a service call is needed to put the switch into state, counting it as
+        #   suppressed if not
+        settling = ((self.commanded == state) and (self.observed_at < self.commanded_at)
+                    and (time.monotonic() - self.commanded_at < SETTLE_SECONDS))
+        if self.observed == state or settling:
+            self.calls_suppressed = self.calls_suppressed + 1
+            return False
+        return True
+
+
+    def Sent(self, state):
+        self.commanded = state
+        self.commanded_at = time.monotonic()
+        self.calls_sent = self.calls_sent + 1
+
+
+    def Counters(self):
+
+        # Returns the counters as a dict, for logging or publishing
+        return { "calls_sent": self.calls_sent, "calls_suppressed": self.calls_suppressed }
+
+
+class SwitchBatch:
+
+
+    def __init__(self, app, entities, debounce = DEBOUNCE_SECONDS):
+
+        self.app = app
+        self.debounce = debounce
+        self.switches = { entity: SwitchActuator(app, entity, debounce) for entity in entities }
+
+        self.requested = {}             # entity: state, requested since the last batch was sent
+        self.pending = None             # handle of the debounce timer, if one is running
+        self.service_calls = 0
+
+
+    def Request(self, entity, state):
+
+        # Ask for one of the switches to be "on" or "off".  The first request starts the debounce
+        #   timer, and everything requested before it runs goes in the same batch, the last
+        #   request for each switch winning.
+        switch = self.switches[entity]
+        if entity in self.requested:
+            switch.calls_suppressed = switch.calls_suppressed + 1
+        switch.desired = state
+        self.requested[entity] = state
+        if self.pending is None:
+            self.pending = self.app.run_in(self.Actuate, self.debounce)
+
+
+    def Actuate(self, kwargs):
+
+        self.pending = None
+        requested = self.requested
+        self.requested = {}
+        entities = { "on": [], "off": [] }
+        for (entity, state) in requested.items():
+            if self.switches[entity].Needed(state):
+                entities[state].append(entity)
+
+        for (state, service) in (("on", "homeassistant/turn_on"), ("off", "homeassistant/turn_off")):
+            if len(entities[state]) > 0:
+                self.app.call_service(service, entity_id = entities[state])
+                self.service_calls = self.service_calls + 1
+                for entity in entities[state]:
+                    self.switches[entity].Sent(state)
+
+
+    def Counters(self):
+
+        # Returns the counters, totalled over all the switches, as a dict
+        return { "calls_sent": sum(switch.calls_sent for switch in self.switches.values()),
+                 "calls_suppressed": sum(switch.calls_suppressed for switch in self.switches.values()),
+                 "service_calls": self.service_calls }
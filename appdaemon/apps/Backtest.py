@@ -0,0 +1,225 @@
+import argparse
+import itertools
+import time
+from bisect import bisect_right
+from datetime import date
+from datetime import datetime
+from datetime import timedelta
+from datetime import timezone
+from zoneinfo import ZoneInfo
+from Slots import SLOT_SECONDS, SlotFromDatetime, NextWindow, WindowRanges
+from SlotAllocation import Load, AllocateSlots
+from PriceArchive import PriceArchive, DEFAULT_ARCHIVE
+
+###############
+# Backtesting of slot selection settings against historical prices
+###############
+
+# Replays a price archive (see PriceArchive.py) through the same slot selection as
+#   OctopusAnalysis.Analyse and the same switching rules as the switching apps, to show what a
+#   choice of time window, number of slots and HEADROOM would have cost.
+#
+# For each day, thresholds are chosen at half past the update hour, standing in for the time the
+#   next day's prices arrive, when Analyse allocates the loads again: the cheapest slots of the next
+#   window occurrence, among the prices from an hour earlier to 25 hours later, plus headroom.  The
+#   update hour can be varied, to see what difference late prices would make.  That threshold then
+#   applies to every slot in the window until the next day's update.
+#
+# Many policies can be tested at once.  Policies sharing a time window and update hour share all
+#   the per-day work: the allocation is done once for the largest number of slots wanted, and the
+#   in-window prices are sorted once, with running totals of cost and of switch-ons.  Each policy
+#   then only needs a binary search per day to find how many slots its threshold switches on, so
+#   a sweep of hundreds of policies over a year of prices takes a second or so.
+#
+# Run as a script, for example:
+#
+#   python3 Backtest.py --from 2023-01-01 --to 2024-01-01 --start 00:00,23:00 --stop 07:00,08:00 --slots 2-10
+DEFAULT_TIME_ZONE = "Europe/London"
+
+# Defaults matching HEADROOM and the default thresholds in Octopus.py
+DEFAULT_HEADROOM = 0.01
+DEFAULT_THRESHOLD = 9
+
+# The hour by which the backtest assumes the next day's prices have arrived, as Octopus usually
+#   publishes them in the afternoon.  OctopusAnalysis itself polls until they arrive (see AWAIT_PRICES).
+DEFAULT_UPDATE_HOUR = 16
+
+
+class Policy:
+
+
+    def __init__(self, start, stop, slots, headroom = DEFAULT_HEADROOM, update_hour = DEFAULT_UPDATE_HOUR,
+                 default_threshold = DEFAULT_THRESHOLD, kw = 1.0):
+
+        # start, stop       - daily window, in minutes past midnight local time
+        # slots             - number of slots wanted (as in tesla_min_slots etc.)
+        # headroom          - added to the dearest selected price to give the threshold
+        # update_hour       - hour in which thresholds are recalculated, when the prices arrive
+        # default_threshold - threshold used when no slots are found
+        # kw                - power drawn by the load when on, for the cost and energy totals
+        self.start = start
+        self.stop = stop
+        self.slots = slots
+        self.headroom = headroom
+        self.update_hour = update_hour
+        self.default_threshold = default_threshold
+        self.kw = kw
+
+        # Results, filled in by Backtest
+        self.days = 0
+        self.slots_on = 0
+        self.switches = 0
+        self.kwh = 0.0
+        self.cost = 0.0
+
+
+    def AveragePrice(self):
+        return self.cost / self.kwh if self.kwh > 0 else 0.0
+
+
+class DayPrices:
+
+
+    def __init__(self, rates):
+
+        # The in-window slots of one day, sorted by price, with running totals so that the number of
+        #   slots, cost and number of switch-ons for any threshold can be read off after one search.
+        rates = sorted(rates, key = lambda rate: (rate[1], rate[0]))
+        self.prices = [price for (slot, price) in rates]
+        self.price_totals = list(itertools.accumulate(self.prices, initial = 0))
+
+        # Switching a slot on starts a new run unless a neighbour is already on, and joins two runs
+        #   into one if both are, so each slot changes the number of runs by 1 - neighbours on.
+        on = set()
+        changes = []
+        for (slot, price) in rates:
+            changes.append(1 - ((slot - 1) in on) - ((slot + 1) in on))
+            on.add(slot)
+        self.run_totals = list(itertools.accumulate(changes, initial = 0))
+
+
+def Backtest(first_slot, prices, from_date, to_date, policies, time_zone = DEFAULT_TIME_ZONE):
+
+    # Replays the prices (a sequence of prices for consecutive slots from first_slot, NaN where
+    #   missing) for each day from from_date up to to_date, filling in the results of each policy.
+    #   Returns the policies.
+    zone = ZoneInfo(time_zone)
+    end_slot = first_slot + len(prices)
+
+    def Price(slot):
+        if first_slot <= slot < end_slot:
+            price = prices[slot - first_slot]
+            if price == price:          # NaN is never equal to itself
+                return price
+        return None
+
+    def UpdateSlot(day, update_hour):
+        ts_update = datetime(day.year, day.month, day.day, update_hour, 30, tzinfo = zone)
+        return ts_update, SlotFromDatetime(ts_update)
+
+    groups = {}
+    for policy in policies:
+        groups.setdefault((policy.start, policy.stop, policy.update_hour), []).append(policy)
+
+    for ((start, stop, update_hour), group) in groups.items():
+        slots_wanted = max(policy.slots for policy in group)
+        day = from_date
+        while day < to_date:
+            # Selection, as done by Analyse at the update time
+            ts_update, update_slot = UpdateSlot(day, update_hour)
+            ts_utc = ts_update.astimezone(timezone.utc)
+            from_slot = SlotFromDatetime(ts_utc - timedelta(hours = 1))
+            to_slot = SlotFromDatetime(ts_utc - timedelta(hours = 1) + timedelta(hours = 26))
+            window_from, window_to = NextWindow(start, stop, ts_update, zone)
+
+            rates = []
+            for slot in range(from_slot, to_slot):
+                price = Price(slot)
+                if price is not None:
+                    rates.append((slot, price))
+            load = AllocateSlots(rates, [Load("backtest", window_from, window_to, slots_wanted)])[0]
+            allocated = [price for (slot, price) in load.allocation]
+
+            # Switching, from this update until the next one, as done by the switching apps
+            next_update, next_slot = UpdateSlot(day + timedelta(days = 1), update_hour)
+            in_window = []
+            for (window_from, window_to) in WindowRanges(start, stop, update_slot, next_slot, zone):
+                for slot in range(window_from, window_to):
+                    price = Price(slot)
+                    if price is not None:
+                        in_window.append((slot, price))
+            day_prices = DayPrices(in_window)
+
+            for policy in group:
+                if policy.slots > 0 and len(allocated) > 0:
+                    threshold = round(allocated[min(policy.slots, len(allocated)) - 1] + policy.headroom, 3)
+                else:
+                    threshold = policy.default_threshold
+                count = bisect_right(day_prices.prices, threshold)
+                policy.days = policy.days + 1
+                policy.slots_on = policy.slots_on + count
+                policy.switches = policy.switches + day_prices.run_totals[count]
+                policy.kwh = policy.kwh + count * policy.kw * SLOT_SECONDS / 3600
+                policy.cost = policy.cost + day_prices.price_totals[count] * policy.kw * SLOT_SECONDS / 3600
+
+            day = day + timedelta(days = 1)
+
+    return policies
+
+
+def ParseList(value, convert):
+
+    # Parse a comma separated list, where integer items may also be ranges, e.g. "1-4,8"
+    items = []
+    for item in value.split(","):
+        if convert is int and "-" in item[1:]:
+            low, high = item.split("-")
+            items.extend(range(int(low), int(high) + 1))
+        else:
+            items.append(convert(item))
+    return items
+
+
+def Minutes(value):
+    hours, minutes = value.split(":")[0:2]
+    return int(hours) * 60 + int(minutes)
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description = "Backtest slot selection settings against a price archive")
+    parser.add_argument("--archive", default = DEFAULT_ARCHIVE, help = "price archive, default " + DEFAULT_ARCHIVE)
+    parser.add_argument("--from", dest = "date_from", required = True, help = "first day, YYYY-MM-DD")
+    parser.add_argument("--to", dest = "date_to", required = True, help = "day to stop at, YYYY-MM-DD")
+    parser.add_argument("--start", default = "00:00", help = "window start times, e.g. 00:00,23:00")
+    parser.add_argument("--stop", default = "08:00", help = "window stop times, e.g. 07:00,08:00")
+    parser.add_argument("--slots", default = "4", help = "numbers of slots, e.g. 2-8")
+    parser.add_argument("--headroom", default = str(DEFAULT_HEADROOM), help = "headroom values, e.g. 0.01,0.5")
+    parser.add_argument("--update-hour", default = str(DEFAULT_UPDATE_HOUR), help = "update hours, e.g. 16,18")
+    parser.add_argument("--default-threshold", type = float, default = DEFAULT_THRESHOLD)
+    parser.add_argument("--kw", type = float, default = 1.0, help = "power drawn by the load, kW")
+    parser.add_argument("--time-zone", default = DEFAULT_TIME_ZONE)
+    parser.add_argument("--top", type = int, default = 20, help = "number of results to show")
+    args = parser.parse_args()
+
+    policies = []
+    for (start, stop, slots, headroom, update_hour) in itertools.product(
+            ParseList(args.start, Minutes), ParseList(args.stop, Minutes), ParseList(args.slots, int),
+            ParseList(args.headroom, float), ParseList(args.update_hour, int)):
+        policies.append(Policy(start, stop, slots, headroom, update_hour, args.default_threshold, args.kw))
+
+    archive = PriceArchive(args.archive)
+    first_slot, prices = archive.Prices()
+    ts_start = time.perf_counter()
+    Backtest(first_slot, prices, date.fromisoformat(args.date_from), date.fromisoformat(args.date_to), policies, args.time_zone)
+    elapsed = time.perf_counter() - ts_start
+
+    print("start  stop   slots  headroom  update     kWh    cost(p)  p/kWh  switch-ons")
+    for policy in sorted(policies, key = Policy.AveragePrice)[0:args.top]:
+        print("%02d:%02d  %02d:%02d  %5d  %8.3f  %6d  %6.1f  %9.1f  %5.2f  %10d" % (
+              policy.start // 60, policy.start % 60, policy.stop // 60, policy.stop % 60, policy.slots,
+              policy.headroom, policy.update_hour, policy.kwh, policy.cost, policy.AveragePrice(), policy.switches))
+    print(str(len(policies)) + " policies over " + str(policies[0].days if policies else 0) + " days in " +
+          str(round(elapsed, 2)) + "s")
+    prices.release()
+    archive.Close()
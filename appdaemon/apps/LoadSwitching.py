@@ -0,0 +1,418 @@
+import hassapi as hass
+import math
+import time
+from datetime import datetime
+from datetime import timezone
+from zoneinfo import ZoneInfo
+from Slots import SLOT_SECONDS, SlotFromDatetime, DatetimeFromSlot, LocalDatetimeFromSlot, NextTimeSlot, WindowRanges
+from Timeline import TimeOfDay, BuildTimeline, SlotTimeline
+from Actuator import SwitchBatch
+from Metrics import Metrics, Timed
+from SlotAllocation import Load, AllocateSlots, MODE_CHEAPEST
+from PriceTimeline import TimelineFromRates
+
+# Logging levels: 1 - Errors only
+#                 2 - Information messages
+#                 3 - Debug messages
+LOGERROR = 1
+LOGINFO = 2
+LOGDEBUG = 3
+
+LOGLEVEL = LOGINFO
+
+###############
+# Switching of any number of loads to follow the thresholds set by OctopusAnalysis
+###############
+
+# One instance switches all the devices listed under "devices" in its arguments in apps.yaml, each
+#   with the HA entities for its switch, threshold and time window (as published and read by
+#   OctopusAnalysis), and optionally:
+#   - "override", an input_boolean which, when on, turns the device on regardless;
+#   - "preconditions", a mapping of entity: state, such as a presence tracker that must be "home"
+#     or a plug sensor that must be "on".  Until they all hold, the device is left as it is;
+#   - "charge", for a car or other battery, which is charged to a target by a departure time rather
+#     than on the threshold.  It names the entities holding the state of charge ("soc") and target
+#     ("target_soc"), both in %, and the departure time ("departure"), and gives the battery's
+#     capacity ("battery_kwh"), the charger's power ("kw") and optionally the charging efficiency.
+#     The slots needed to deliver the energy are the cheapest ones in the device's time window
+#     before departure, taken from the price timeline OctopusAnalysis already holds, so plugging in,
+#     or a change of charge or target, is planned again in well under a millisecond without calling
+#     the API.  They are chosen in the mode of the device's load in OctopusAnalysis ("load", or else
+#     the same name as the device), so "mode: block" charges in one run.  Slots that OctopusAnalysis
+#     has filled up to the site capacity with other loads are passed over, and the device is planned
+#     again whenever their slots change.  The plan is published as sensor.<device>_charge_plan, with
+#     the time it took, for OctopusAnalysis to fit the other loads around (see "charge_plan" in
+#     Octopus.py).  Until the prices reach the end of the window, as before the next day's prices
+#     are out, or if the state of charge, target or departure time can't be read, the plan is
+#     withdrawn and the threshold and window are used as before.
+#
+# Changes to any of these, or to the prices, mark the devices they affect, and a single plan runs
+#   for all of them once the burst of changes is over, so the several thresholds OctopusAnalysis
+#   publishes at once make one pass, not one per device.  Each device gets an on/off timeline (see
+#   Timeline.py), and one timer is kept, for the next slot boundary at which any device changes.
+#   Switching goes through a SwitchBatch (see Actuator.py), so the devices changing together are
+#   switched with at most one turn_on and one turn_off call between them.  The numbers of callbacks,
+#   timers and service calls stay much the same however many devices there are.
+#
+# TeslaSwitching and ImmersionSwitching (Tesla.py and Immersion.py) are this app with one device each.
+
+# Half-hourly prices published by OctopusAnalysis, and the app itself, for its price timeline
+OCTOPUS_RATES = "sensor.octopus_rates"
+OCTOPUS_APP = "OctopusAnalysis"
+
+# The entities of a device that, when they change, mean it needs planning again
+DEVICE_ENTITIES = ("threshold", "start_time", "stop_time", "override")
+CHARGE_ENTITIES = ("soc", "target_soc", "departure")
+
+# Proportion of the energy drawn from the charger that ends up in the battery, unless set with "efficiency"
+DEFAULT_CHARGE_EFFICIENCY = 0.9
+
+
+def StateMatches(state, wanted):
+
+    # Whether an entity's state is the one wanted, ignoring case.  YAML reads on and off as
+    #   booleans unless they are quoted, so those are taken to mean "on" and "off".
+    if isinstance(wanted, bool):
+        wanted = "on" if wanted else "off"
+    return str(state).upper() == str(wanted).upper()
+
+
+class LoadSwitching(hass.Hass):
+
+    # The devices to switch if there are none in apps.yaml; set by the single-device subclasses
+    DEFAULT_DEVICES = {}
+
+
+    def initialize(self):
+
+        # Instrumentation, set up first so that every HA call is counted
+        self.metrics = Metrics(self, self.args.get("metrics", True), self.args.get("metrics_path"))
+
+        self.devices = self.args.get("devices", self.DEFAULT_DEVICES)
+        if len(self.devices) == 0:
+            raise ValueError("No devices configured for " + self.name)
+
+        # Octopus works in UTC, but the time windows are set in local time
+        self.zone = ZoneInfo(self.get_timezone())
+
+        # All switching goes through the batch, which only calls HA for switches needing to change
+        self.switches = SwitchBatch(self, [device["switch"] for device in self.devices.values()])
+
+        # The on/off timeline of each device, the timer for the next change in any of them, and the
+        #   devices waiting to be planned again
+        self.timelines = {}
+        self.timer = None
+        self.timer_slot = None
+        self.dirty = set()
+        self.pending = None
+
+        # The charge plan last published for each device planned on its charge
+        self.charge_plans = {}
+
+        # One listener per entity, for all the devices using it, and one for the prices, for all of them
+        listeners = {}
+        for (name, device) in self.devices.items():
+            for key in DEVICE_ENTITIES:
+                if key in device:
+                    listeners.setdefault((device[key], None), []).append(name)
+            listeners.setdefault((device["threshold"], "slots"), []).append(name)
+            for entity in device.get("preconditions", {}):
+                listeners.setdefault((entity, None), []).append(name)
+            for key in CHARGE_ENTITIES:
+                if key in device.get("charge", {}):
+                    listeners.setdefault((device["charge"][key], None), []).append(name)
+            if "charge" in device:
+                for entity in self.OtherThresholds(name, device):
+                    listeners.setdefault((entity, "slots"), []).append(name)
+        for ((entity, attribute), names) in listeners.items():
+            self.listen_state(self.SettingsChanged, entity, attribute = attribute, devices = names)
+        self.listen_state(self.SettingsChanged, OCTOPUS_RATES, attribute = "prices", devices = list(self.devices))
+
+        # Plan from whatever is already there
+        self.Plan()
+
+
+    def SettingsChanged(self, entity, attribute, old, new, kwargs):
+
+        # Note the devices affected, and plan them all together once the changes stop arriving
+        self.dirty.update(kwargs["devices"])
+        if self.pending is None:
+            self.pending = self.run_in(self.PlanTimer, 0)
+
+
+    def PlanTimer(self, kwargs):
+        self.pending = None
+        names = [name for name in self.devices if name in self.dirty]
+        self.dirty = set()
+        self.Plan(names)
+
+
+    @Timed("plan", publish = True)
+    def Plan(self, names = None):
+
+        # Works out when each of the named devices, or all of them, should be on and off from now
+        #   until the end of the published prices, switches them for the current slot, and moves
+        #   the timer to the next change of any device.  Nothing needs reading from HA when the
+        #   timer fires.
+        if names is None:
+            names = list(self.devices)
+        ts_now = (datetime.now(timezone.utc))
+        self.log(" ")
+        self.log("#########################################################################")
+        self.log(self.name + " Plan executing at: " + str(ts_now) + " UTC")
+        self.log("#########################################################################")
+
+        current_slot = SlotFromDatetime(ts_now)
+        prices = None
+        rates = None
+        for name in names:
+            device = self.devices[name]
+            timeline = []
+            charge_slots = None
+
+            # Load override switches - these allow the user to manually turn on big loads.  Devices
+            # whose preconditions don't hold are left as they are, with no timeline.
+            override = self.get_state(device["override"]) if "override" in device else "off"
+            if override != "off":
+                if LOGLEVEL >= LOGINFO:
+                    self.log(("Override for " + name + ": ").rjust(27) + "on, turning on")
+                timeline = [(current_slot, "on")]
+
+            elif self.PreconditionsHold(name, device):
+                # Get prices from OctopusAnalysis's price timeline, once for all the devices, falling
+                # back to HA if it isn't running, then the device's charge or its threshold price and
+                # time window from HA
+                if prices is None:
+                    prices = self.CurrentTimeline()
+                    rates = prices.Rates(current_slot, prices.end_slot)
+                    if LOGLEVEL >= LOGINFO:
+                        self.log("          Prices for next: " + str(len(rates)) + " slots")
+                charge_slots = self.ChargeSlots(name, device, prices, ts_now, current_slot) if "charge" in device else None
+                if charge_slots is not None:
+                    timeline = SlotTimeline(charge_slots, current_slot)
+                else:
+                    timeline = self.ThresholdTimeline(name, device, rates, current_slot)
+                if LOGLEVEL >= LOGDEBUG:
+                    for (slot, state) in timeline[1:]:
+                        self.log((name + " " + state + " at: ").rjust(27) + str(DatetimeFromSlot(slot)))
+
+            # A device not charging to a plan this time withdraws any plan it had published
+            if "charge" in device and charge_slots is None:
+                self.WithdrawChargePlan(name)
+
+            # Switch for the current slot straight away, as part of the batch
+            self.timelines[name] = timeline
+            if len(timeline) > 0:
+                self.switches.Request(device["switch"], timeline[0][1])
+
+        self.ScheduleTimer(current_slot)
+        self.metrics.Gauge("devices", len(self.devices))
+        self.metrics.Gauge("devices_planned", len(names))
+        self.metrics.Gauge("slots_planned", len(rates or []))
+        self.PublishCounters()
+
+
+    def ThresholdTimeline(self, name, device, rates, current_slot):
+
+        # The device's timeline from the threshold price and time window set for it in HA
+        threshold_state = self.get_state(device["threshold"], attribute = "all")
+        threshold = float(threshold_state["state"])
+        slots = threshold_state["attributes"].get("slots")    # only there for loads run in exact slots
+        start_time = self.get_state(device["start_time"])
+        stop_time = self.get_state(device["stop_time"])
+        if LOGLEVEL >= LOGINFO:
+            self.log((name + " window: ").rjust(27) + start_time + " to " + stop_time)
+            self.log((name + " threshold: ").rjust(27) + str(threshold) +
+                     ("" if slots is None else ", " + str(len(slots)) + " slots"))
+
+        with self.metrics.Stage("timeline"):
+            return BuildTimeline(rates, threshold, TimeOfDay(start_time), TimeOfDay(stop_time),
+                                 self.zone, current_slot, slots)
+
+
+    def PreconditionsHold(self, name, device):
+
+        # Whether all the device's preconditions hold, such as the car being at home
+        for (entity, wanted) in device.get("preconditions", {}).items():
+            state = self.get_state(entity)
+            if not StateMatches(state, wanted):
+                if LOGLEVEL >= LOGINFO:
+                    self.log((name + " waiting for: ").rjust(27) + entity + " to be " + str(wanted) + ", is " + str(state))
+                return False
+        return True
+
+
+    def CurrentTimeline(self):
+
+        # The prices, straight from OctopusAnalysis's price timeline if possible, or else built from
+        #   those it publishes in HA
+        octopus = self.get_app(OCTOPUS_APP)
+        if octopus is not None and getattr(octopus, "price_timeline", None) is not None:
+            return octopus.price_timeline
+        return TimelineFromRates([(slot, price) for (slot, price) in self.get_state(OCTOPUS_RATES, attribute = "prices") or []])
+
+
+    def OctopusLoad(self, name, device):
+
+        # The definition of the device's load in OctopusAnalysis, named by "load" or else the same
+        #   as the device, or an empty one if there isn't one
+        octopus = self.get_app(OCTOPUS_APP)
+        loads = getattr(octopus, "loads", None) or {}
+        return loads.get(device.get("load", name), {})
+
+
+    def OtherThresholds(self, name, device):
+
+        # The threshold entities of OctopusAnalysis's other loads, whose slots, when they change,
+        #   may leave more or less room for the device's charging
+        octopus = self.get_app(OCTOPUS_APP)
+        loads = getattr(octopus, "loads", None) or {}
+        own = device.get("load", name)
+        return [config["threshold"] for (load, config) in loads.items() if load != own]
+
+
+    def ChargeSlots(self, name, device, prices, ts_now, current_slot):
+
+        # The set of slots to charge in to reach the target state of charge by the departure time,
+        #   or None if the state of charge, target, departure time or window can't be read, or the
+        #   prices don't yet reach the end of the window before departure, so that the threshold is
+        #   used.  Only slots in the device's time window are used, chosen in its load's mode.
+        ts_start = time.perf_counter()
+        charge = device["charge"]
+        try:
+            soc = float(self.get_state(charge["soc"]))
+            target = float(self.get_state(charge["target_soc"]))
+            departure_slot = NextTimeSlot(TimeOfDay(self.get_state(charge["departure"])), ts_now, self.zone)
+            start = TimeOfDay(self.get_state(device["start_time"]))
+            stop = TimeOfDay(self.get_state(device["stop_time"]))
+        except (TypeError, ValueError, AttributeError, IndexError):
+            if LOGLEVEL >= LOGINFO:
+                self.log((name + " charge: ").rjust(27) + "charge, departure or window unavailable, using threshold")
+            return None
+
+        # The parts of the window before departure.  Until there are prices for the end of the last
+        #   of them, cheaper slots may yet be published, so the plan would only be provisional.
+        ranges = WindowRanges(start, stop, current_slot, departure_slot, self.zone)
+        if len(ranges) > 0 and prices.Price(ranges[-1][1] - 1) is None:
+            if LOGLEVEL >= LOGINFO:
+                self.log((name + " charge: ").rjust(27) + "no prices to the end of the window yet, using threshold")
+            return None
+
+        # The energy wanted, and the number of slots it takes at the charger's power
+        kw = float(charge["kw"])
+        energy = max(0.0, target - soc) / 100 * float(charge["battery_kwh"]) / float(charge.get("efficiency", DEFAULT_CHARGE_EFFICIENCY))
+        needed = math.ceil(round(energy / (kw * SLOT_SECONDS / 3600), 6))
+
+        # The cheapest slots come straight from the price timeline's index, window by window, while
+        #   the other modes go through the allocator with the prices of the window
+        config = self.OctopusLoad(name, device)
+        mode = config.get("mode", MODE_CHEAPEST)
+        with self.metrics.Stage("charge"):
+            full = self.FullSlots(name, device, kw)
+            if mode == MODE_CHEAPEST:
+                cheapest = sorted((rate for (window_from, window_to) in ranges for rate in prices.Cheapest(needed, window_from, window_to, full)),
+                                  key = lambda rate: (rate[1], rate[0]))
+                slots = set(slot for (slot, price) in cheapest[:needed])
+            else:
+                rates = [(slot, price) for (window_from, window_to) in ranges for (slot, price) in prices.Rates(window_from, window_to)
+                         if full is None or slot not in full]
+                load = Load(name, current_slot, departure_slot, needed, mode, int(config.get("min_run", 1)), config.get("max_starts"))
+                AllocateSlots(rates, [load])
+                slots = set(slot for (slot, price) in load.allocation)
+        latency = round((time.perf_counter() - ts_start) * 1000, 3)
+        self.metrics.Gauge(name + "_charge_plan_ms", latency)
+
+        if LOGLEVEL >= LOGINFO:
+            self.log((name + " charge: ").rjust(27) + str(round(soc)) + "% to " + str(round(target)) + "% by " +
+                     str(LocalDatetimeFromSlot(departure_slot, self.zone)) + ", " + str(round(energy, 1)) + "kWh")
+            self.log((name + " charge slots: ").rjust(27) + str(len(slots)) + " of " + str(needed) + ", " + mode +
+                     ", in " + str(latency) + "ms")
+        plan = (needed, sorted(slots), departure_slot)
+        if self.charge_plans.get(name) != plan:
+            self.set_state("sensor." + name + "_charge_plan", state = len(slots),
+                           attributes = { "slots_needed": needed, "slots": sorted(slots), "energy_kwh": round(energy, 2),
+                                          "departure": str(LocalDatetimeFromSlot(departure_slot, self.zone)),
+                                          "latency_ms": latency })
+            self.charge_plans[name] = plan
+        return slots
+
+
+    def WithdrawChargePlan(self, name):
+
+        # Publish that the device has no charge plan, so that OctopusAnalysis allocates its load as usual
+        if name in self.charge_plans and self.charge_plans[name] is None:
+            return
+        self.set_state("sensor." + name + "_charge_plan", state = 0,
+                       attributes = { "slots_needed": None, "slots": None, "energy_kwh": None, "departure": None })
+        self.charge_plans[name] = None
+
+
+    def FullSlots(self, name, device, kw):
+
+        # The slots without room for the charger within OctopusAnalysis's site capacity, given what it
+        #   has allocated to the other loads, or None if there is no site capacity.  The device's own
+        #   load there, named by "load" or else the same as the device, is left out, as the charge
+        #   plan takes its place.
+        octopus = self.get_app(OCTOPUS_APP)
+        capacity = getattr(octopus, "site_capacity", None)
+        if capacity is None:
+            return None
+        own = device.get("load", name)
+        used = {}
+        for (load, allocated) in list(octopus.allocated.items()):
+            if load != own:
+                for slot in allocated["slots"] or []:
+                    used[slot] = used.get(slot, 0) + allocated["kw"]
+        return set(slot for (slot, kw_used) in used.items() if capacity - kw_used < kw)
+
+
+    def ScheduleTimer(self, current_slot):
+
+        # Keep one timer, for the first slot after current_slot at which any device changes.  It is
+        #   left alone if it is already set for that slot.
+        changes = [slot for timeline in self.timelines.values() for (slot, state) in timeline if slot > current_slot]
+        next_slot = min(changes) if len(changes) > 0 else None
+        if next_slot == self.timer_slot:
+            return
+        if self.timer is not None:
+            self.cancel_timer(self.timer)
+            self.timer = None
+        self.timer_slot = next_slot
+        if next_slot is not None:
+            ts_switch = DatetimeFromSlot(next_slot).replace(tzinfo = timezone.utc)
+            if LOGLEVEL >= LOGINFO:
+                self.log("        Next switch due at: " + str(ts_switch.astimezone(self.zone)))
+            self.timer = self.run_at(self.SwitchTimer, ts_switch, slot = next_slot)
+        self.metrics.Gauge("timers_set", 0 if self.timer is None else 1)
+
+
+    def SwitchTimer(self, kwargs):
+
+        # Switch every device changing in this slot, in one batch, then wait for the next change
+        slot = kwargs["slot"]
+        self.timer = None
+        self.timer_slot = None
+        for (name, timeline) in self.timelines.items():
+            for (change_slot, state) in timeline:
+                if change_slot == slot:
+                    if LOGLEVEL >= LOGINFO:
+                        self.log(("Turning " + name + ": ").rjust(27) + state)
+                    self.switches.Request(self.devices[name]["switch"], state)
+
+        # A device whose timeline ends here has come to the end of the prices, or of the windows they
+        #   cover, so it is planned again from what is held now.  Nothing else would plan it again
+        #   while Octopus can't be reached, and this keeps it running on its window until it can.
+        ended = [name for (name, timeline) in self.timelines.items() if len(timeline) > 1 and timeline[-1][0] == slot]
+        if len(ended) > 0:
+            self.dirty.update(ended)
+            if self.pending is None:
+                self.pending = self.run_in(self.PlanTimer, 0)
+        self.ScheduleTimer(slot)
+        self.PublishCounters()
+
+
+    def PublishCounters(self):
+        for (counter, value) in self.switches.Counters().items():
+            self.metrics.Gauge("switch_" + counter, value)
+        if LOGLEVEL >= LOGDEBUG:
+            self.log("Switch calls: " + str(self.switches.Counters()))
@@ -0,0 +1,210 @@
+import asyncio
+import collections
+import functools
+import os
+import time
+
+###############
+# Instrumentation shared by the apps: stage timings, HA call counts and other figures, published
+# to HA and as a Prometheus text file
+###############
+
+# Each app creates a Metrics object, as self.metrics, first thing in initialize, and then:
+#   - wraps the stages of its work in "with self.metrics.Stage(name):" to time them, or decorates
+#     whole methods with @Timed(name);
+#   - calls Count(name, n) for things that happen (slots downloaded, API failures and so on),
+#     and Gauge(name, value) for figures where only the latest value matters (API latency);
+#   - calls Publish at the end of each run.
+#
+# The HA API calls the app makes are counted by wrapping them, so nothing needs adding at each call.
+#   Recording only ever adds to a number in a dict; nothing is formatted until Publish, which sets
+#   one HA sensor per app, "sensor.<app name>_metrics", with the total time of the run as its state
+#   and everything else as attributes, and, if a directory is given, rewrites <app name>.prom there
+#   in the Prometheus text format, for node_exporter's textfile collector to pick up.
+#
+# Instrumentation is turned off with "metrics: false" in the app's arguments in apps.yaml, in which
+#   case nothing is wrapped, Stage hands back a context manager that does nothing, and the other
+#   methods return straight away.  The Prometheus directory is set with "metrics_path".
+METRIC_PREFIX = "ha_switching_"
+
+# The HA API calls counted
+HA_CALLS = ("get_state", "set_state", "turn_on", "turn_off", "call_service", "listen_state",
+            "run_in", "run_at", "run_hourly", "cancel_timer")
+
+
+class NoStage:
+
+    # Stands in for a StageTimer when instrumentation is off
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+
+NO_STAGE = NoStage()
+
+
+class StageTimer:
+
+
+    def __init__(self, metrics, stage):
+        self.metrics = metrics
+        self.stage = stage
+
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+
+    def __exit__(self, exc_type, exc, tb):
+
+        # [runs, total seconds, seconds taken by the last run]
+        elapsed = time.perf_counter() - self.start
+        totals = self.metrics.stages.setdefault(self.stage, [0, 0.0, 0.0])
+        totals[0] = totals[0] + 1
+        totals[1] = totals[1] + elapsed
+        totals[2] = elapsed
+        if exc_type is not None:
+            self.metrics.counters["errors"] += 1
+        return False
+
+
+class Metrics:
+
+
+    def __init__(self, app, enabled = True, directory = None):
+
+        # app       - the hassapi.Hass app being instrumented
+        # enabled   - False to turn instrumentation off
+        # directory - where to write the Prometheus text file, or None for no file
+        self.app = app
+        self.name = app.name
+        self.enabled = enabled
+        self.directory = directory
+        self.entity = "sensor." + app.name.lower() + "_metrics"
+
+        self.stages = {}
+        self.counters = collections.Counter()
+        self.gauges = {}
+        self.calls = collections.Counter()
+
+        # Kept unwrapped, so that publishing isn't counted
+        self.set_state = app.set_state
+        if enabled:
+            for call in HA_CALLS:
+                if hasattr(app, call):
+                    setattr(app, call, self.Counted(call, getattr(app, call)))
+
+
+    def Counted(self, call, method):
+
+        calls = self.calls
+
+        def Wrapper(*args, **kwargs):
+            calls[call] += 1
+            return method(*args, **kwargs)
+        return Wrapper
+
+
+    def Stage(self, stage):
+        if not self.enabled:
+            return NO_STAGE
+        return StageTimer(self, stage)
+
+
+    def Count(self, name, n = 1):
+        if self.enabled:
+            self.counters[name] += n
+
+
+    def Gauge(self, name, value):
+        if self.enabled:
+            self.gauges[name] = value
+
+
+    def Publish(self, run_stage = None):
+
+        # Publish everything recorded so far.  run_stage names the stage timing the whole run,
+        #   whose latest time becomes the state of the sensor.
+        if not self.enabled:
+            return
+        ts_now = time.time()
+        attributes = { "unit_of_measurement": "ms", "last_published": round(ts_now) }
+        for (stage, (runs, total, last)) in self.stages.items():
+            attributes[stage + "_ms"] = round(last * 1000, 2)
+            attributes[stage + "_runs"] = runs
+        attributes.update(self.counters)
+        attributes.update(self.gauges)
+        attributes["ha_calls"] = sum(self.calls.values())
+        state = round(self.stages[run_stage][2] * 1000, 2) if run_stage in self.stages else 0
+        self.set_state(self.entity, state = state, attributes = attributes)
+
+        if self.directory is not None:
+            self.WritePrometheus(ts_now)
+
+
+    def PrometheusText(self, ts_now):
+
+        # The metrics in the Prometheus text exposition format
+        app = 'app="' + self.name + '"'
+        lines = []
+
+        def Family(name, kind, help_text, samples):
+            if len(samples) == 0:
+                return
+            lines.append("# HELP " + METRIC_PREFIX + name + " " + help_text)
+            lines.append("# TYPE " + METRIC_PREFIX + name + " " + kind)
+            for (labels, value) in samples:
+                lines.append(METRIC_PREFIX + name + "{" + ",".join([app] + labels) + "} " + repr(float(value)))
+
+        stages = sorted(self.stages.items())
+        Family("stage_seconds", "gauge", "Time taken by the last run of each stage.",
+               [(['stage="' + stage + '"'], last) for (stage, (runs, total, last)) in stages])
+        Family("stage_seconds_total", "counter", "Total time taken by each stage.",
+               [(['stage="' + stage + '"'], total) for (stage, (runs, total, last)) in stages])
+        Family("stage_runs_total", "counter", "Number of runs of each stage.",
+               [(['stage="' + stage + '"'], runs) for (stage, (runs, total, last)) in stages])
+        Family("ha_calls_total", "counter", "Number of calls made to the HA API.",
+               [(['call="' + call + '"'], count) for (call, count) in sorted(self.calls.items())])
+        Family("events_total", "counter", "Number of times each event has happened.",
+               [(['event="' + name + '"'], count) for (name, count) in sorted(self.counters.items())])
+        Family("value", "gauge", "Latest value of each figure recorded.",
+               [(['name="' + name + '"'], value) for (name, value) in sorted(self.gauges.items()) if value is not None])
+        Family("last_published_timestamp_seconds", "gauge", "Time the metrics were last published.", [([], ts_now)])
+        return "\n".join(lines) + "\n"
+
+
+    def WritePrometheus(self, ts_now):
+
+        # Written to a temporary file and renamed into place, so the collector never reads half a file
+        os.makedirs(self.directory, exist_ok = True)
+        path = os.path.join(self.directory, self.name + ".prom")
+        with open(path + ".tmp", "w") as f:
+            f.write(self.PrometheusText(ts_now))
+        os.replace(path + ".tmp", path)
+
+
+def Timed(stage, publish = False):
+
+    # Decorator timing a whole method of an app as a stage, and publishing the metrics after it if
+    #   publish is set.  Async methods are timed too, but can't publish, as Publish calls HA.
+    def Decorator(method):
+        if asyncio.iscoroutinefunction(method):
+            @functools.wraps(method)
+            async def AsyncWrapper(self, *args, **kwargs):
+                with self.metrics.Stage(stage):
+                    return await method(self, *args, **kwargs)
+            return AsyncWrapper
+
+        @functools.wraps(method)
+        def Wrapper(self, *args, **kwargs):
+            with self.metrics.Stage(stage):
+                result = method(self, *args, **kwargs)
+            if publish:
+                self.metrics.Publish(stage)
+            return result
+        return Wrapper
+    return Decorator
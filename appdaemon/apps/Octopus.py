@@ -1,10 +1,19 @@
 import hassapi as hass
+import asyncio
+import math
 from datetime import datetime
 from datetime import timezone
 from datetime import timedelta
 from datetime import time
-import requests
-import iso8601
+from zoneinfo import ZoneInfo
+from Slots import SLOT_SECONDS, SLOTS_PER_DAY, SlotFromDatetime, DatetimeFromSlot, LocalDatetimeFromSlot, SlotToISO, NextWindow
+from RateStore import RateStore
+from OctopusAPI import OctopusClient, OctopusError, RatesURL, RatesFromRecords
+from SlotAllocation import Load, AllocateSlots, MODE_CHEAPEST
+from Timeline import TimeOfDay
+from Metrics import Metrics, Timed
+from PriceTimeline import TimelineFromRates, AlignedTimelines, NetTimeline
+from Snapshot import SaveSnapshot, LoadSnapshot
 
 # Logging levels: 1 - Errors only
 #                 2 - Information messages
@@ -19,6 +28,14 @@ LOGLEVEL = LOGINFO
 # constants for configuration - edit to suit your Octopus Account and consumption requirements
 ###############
 
+# The tariffs to fetch prices for, used unless overridden by the "tariffs" argument in apps.yaml.
+#   Each has a name, and either its Octopus product and tariff codes, as "product" and "tariff",
+#   or the full URL of its unit rates, as "url".  "import" is the tariff you buy electricity on,
+#   whose prices the switching apps work with.  "export", if given, is the tariff you are paid on
+#   for electricity you export, such as Agile Outgoing, and adds "net" prices, the import price
+#   less the export price, for loads to be scheduled on.  Any others, such as the same tariff in
+#   other regions, are fetched and held alongside for comparison.
+#
 # 'AGILE-18-02-21' is the product code, which appears to be valid for Agile throughout the UK
 #     but should perhaps be assumed to be subject to change in future
 #
@@ -27,9 +44,12 @@ LOGLEVEL = LOGINFO
 #     correct tariff code for your area, cunningly hidden in the URL under "Unit Rates" towards
 #     the bottom of the page.  Mostly it just seems to be the final letter that changes per 
 #     region.
-OCTOPUS_PRODUCT_CODE = "AGILE-18-02-21"
-OCTOPUS_TARIFF_CODE = "E-1R-AGILE-18-02-21-K"
-OCTOPUS_URL = "https://api.octopus.energy/v1/products/" + OCTOPUS_PRODUCT_CODE + "/electricity-tariffs/" + OCTOPUS_TARIFF_CODE + "/standard-unit-rates/"
+IMPORT_TARIFF = "import"
+EXPORT_TARIFF = "export"
+NET_PRICES = "net"
+DEFAULT_TARIFFS = {
+    IMPORT_TARIFF: { "product": "AGILE-18-02-21", "tariff": "E-1R-AGILE-18-02-21-K" },
+}
 
 # Some defaults for the start/stop costs.  Note that these are used if no new values are found,
 #    they do not act as limits if any new values are extracted.
@@ -39,191 +59,548 @@ DEFAULT_WH_THRESHOLD = 9
 DEFAULT_CURRENT_COST = 25
 DEFAULT_MINIMUM_COST = 25
 
-# Time in which to update start/stop values.  Specified as a single hour value,
-#    which means the routine will run at least twice, on the hour and half past the hour,
-#    just in case the first time fails for whatever reason.  
-UPDATE_TIMESLOT = 20
+# When to look for new prices.  Octopus publishes the next day's prices some time in the
+#    afternoon, so once the prices held run out within AWAIT_PRICES, the API is polled for
+#    more, first after POLL_MIN_DELAY seconds, then backing off to POLL_MAX_DELAY between polls,
+#    until they arrive.  Polling then stops until the new prices in turn start to run out.
+AWAIT_PRICES = timedelta(hours = 9)
+POLL_MIN_DELAY = 300
+POLL_MAX_DELAY = 1800
+
+# Location of the local rate store, used unless overridden by the "rate_store" argument in apps.yaml.
+#   Prices already held here are never downloaded again.
+DEFAULT_RATE_STORE = "/config/appdaemon/octopus_rates.db"
+
+# Location of the snapshot of prices and schedule, used unless overridden by the "snapshot" argument
+#   in apps.yaml, or turned off with "snapshot: false".  Read at start-up, so that switching carries
+#   on from where it left off without waiting for the rate store or the API (see Snapshot.py).
+DEFAULT_SNAPSHOT = "/config/appdaemon/octopus_snapshot.json"
+
+# The loads to find cheap slots for, used unless overridden by the "loads" argument in apps.yaml.
+#   Each load names the HA entities holding its time window and the number of slots it wants,
+#   the entity to publish its threshold price to, and the threshold to use if no slots are found.
+#   A load may also set "mode" to "block" for one run of consecutive slots, or to "runs" with
+#   "min_run" and "max_starts" to limit how often it is switched on (see SlotAllocation.py).
+#   If the loads share a site capacity (the "site_capacity" argument in apps.yaml, in kW), each
+#   load also needs its power in "kw", and may name an HA entity holding the energy it needs, in
+#   kWh, as "energy", to use in place of min_slots.  A load is scheduled on the import prices
+#   unless it names other prices as "price", such as "net" or another tariff, in which case it
+#   runs in exactly the slots chosen for it, as its threshold isn't in import prices.
+#   A load charged to a target by LoadSwitching (see "charge" in LoadSwitching.py) names the
+#   sensor its charge plan is published to as "charge_plan".  While there is a plan, the load is
+#   taken to run in the plan's slots rather than being allocated here, and the other loads are
+#   allocated again around them whenever the plan changes.
+DEFAULT_LOADS = {
+    "tesla": {
+        "start_time": "input_datetime.tesla_start_time",
+        "stop_time": "input_datetime.tesla_stop_time",
+        "min_slots": "input_number.tesla_min_slots",
+        "threshold": "input_number.tesla_threshold",
+        "default_threshold": DEFAULT_TESLA_THRESHOLD,
+        "charge_plan": "sensor.tesla_charge_plan",
+    },
+    "wh": {
+        "start_time": "input_datetime.wh_start_time",
+        "stop_time": "input_datetime.wh_stop_time",
+        "min_slots": "input_number.wh_min_slots",
+        "threshold": "input_number.wh_threshold",
+        "default_threshold": DEFAULT_WH_THRESHOLD,
+    },
+}
+
+
+def TariffURLs(tariffs):
+
+    # The unit rates URL of each tariff in the "tariffs" argument, by name
+    if IMPORT_TARIFF not in tariffs:
+        raise ValueError("No " + IMPORT_TARIFF + " tariff configured")
+    return { name: config["url"] if "url" in config else RatesURL(config["product"], config["tariff"])
+             for (name, config) in tariffs.items() }
+
 
 class OctopusAnalysis(hass.Hass):
 
 
     def initialize(self):
 
-        # Call Analyse method to initialise prices on first run
-        self.Analyse({ })
-        
-        # Set the scheduled callback to Analyse for every thirty minutes, on the hour and on the half-hour
-        # This needs two calls to run_hourly
+        # Instrumentation, set up first so that every HA call is counted
+        self.metrics = Metrics(self, self.args.get("metrics", True), self.args.get("metrics_path"))
+
+        # Open the persistent rate store, and the client used to talk to the Octopus API.  All
+        #   the tariffs are fetched together, sharing the client's connections.
+        self.rate_store = RateStore(self.args.get("rate_store", DEFAULT_RATE_STORE))
+        self.octopus = OctopusClient()
+        self.tariffs = TariffURLs(self.args.get("tariffs", DEFAULT_TARIFFS))
+
+        # The prices loads can be scheduled on: those of each tariff, and net prices if there is an export tariff
+        self.price_bases = [IMPORT_TARIFF] + [name for name in self.tariffs if name != IMPORT_TARIFF]
+        if EXPORT_TARIFF in self.tariffs:
+            self.price_bases.append(NET_PRICES)
+
+        # Read the definitions of the loads to schedule, and the power they can draw between them
+        self.loads = self.args.get("loads", DEFAULT_LOADS)
+        self.site_capacity = self.args.get("site_capacity")
+        for (name, config) in self.loads.items():
+            if config.get("price", IMPORT_TARIFF) not in self.price_bases:
+                raise ValueError("Unknown prices for " + name + ": " + str(config.get("price")))
+
+        # Octopus works in UTC, but the time windows are set in local time
+        self.zone = ZoneInfo(self.get_timezone())
+
+        # The prices held from an hour ago onwards, as read from the rate store after each fetch that
+        #   brings new ones, so that Analyse never needs the network or the store.  The timeline is
+        #   also there for the other apps to read, with get_app (see PriceTimeline.py), and is
+        #   replaced, never changed, when new prices arrive.  rates_version goes up whenever it is.
+        #   price_timelines holds the timelines of all the price bases, aligned on the same slots,
+        #   and price_timeline is the import one.  prices_end is the slot after the last one every
+        #   tariff has a price for.
+        self.price_timelines = { name: TimelineFromRates([]) for name in self.price_bases }
+        self.price_timeline = self.price_timelines[IMPORT_TARIFF]
+        self.prices_end = None
+        self.rates_version = 0
+        self.store_loaded = False
+        self.poll_delay = POLL_MIN_DELAY
+
+        # What was last allocated to each load and published, so that only loads whose inputs or
+        #   prices have changed are allocated again, and HA is only told about things that change
+        self.allocated = {}
+        self.published_version = 0
+        self.published_costs = None
+
+        # Keep a copy of the user's settings for each load, and run the Analyse method whenever
+        # one of them changes (e.g. "tesla_min_slots"), to recalculate the values.
+        # This is done before anything that schedules Analyse, which reads them.
+        self.inputs = {}
+        for config in self.loads.values():
+            for key in ("start_time", "stop_time", "min_slots", "energy"):
+                if key in config:
+                    self.inputs[config[key]] = self.get_state(config[key])
+                    self.listen_state(self.VariablesChanged, config[key])
+            if "charge_plan" in config:
+                self.inputs[config["charge_plan"]] = self.get_state(config["charge_plan"], attribute = "slots")
+                self.listen_state(self.VariablesChanged, config["charge_plan"], attribute = "slots")
+
+        # Start from the last run's prices and schedule if there's a snapshot of them, rather than
+        #   leave the switching apps without either until Refresh has been to the store and the API.
+        self.snapshot_path = self.args.get("snapshot", DEFAULT_SNAPSHOT)
+        self.saved_version = None
+        if self.snapshot_path:
+            self.RestoreSnapshot()
+
+        # Call Refresh to initialise prices on first run.  Refresh fetches asynchronously, then
+        # hands over to Analyse, so AppDaemon start-up never waits on the network.  From then on
+        # Refresh schedules itself, for when new prices are due.
+        self.run_in(self.Refresh, 0)
+
+        # Set the scheduled callback to Analyse for every thirty minutes, on the hour and on the half-hour,
+        # to keep the current price up to date.  This needs two calls to run_hourly
         ts_start = time(0, 0, 0)
         self.run_hourly(self.Analyse, ts_start)
         ts_start = time(0, 30, 0)
         self.run_hourly(self.Analyse, ts_start)
 
-        # Just as a bonus, run the Analyse method if the users changes the "tesla_min_slots"
-        # or "wh_min_slots" sensors, to recalculate the values
-        self.listen_state(self.VariablesChanged, "input_number.tesla_min_slots")
-        self.listen_state(self.VariablesChanged, "input_number.wh_min_slots")
+
+    def RestoreSnapshot(self):
+
+        # Take up the prices and allocations saved by the last run, and publish the thresholds
+        #   straight away, as after a restart of HA they are back to their initial values.
+        #   Analyse then runs on the restored prices, and again once Refresh has found any newer ones.
+        with self.metrics.Stage("restore"):
+            snapshot = LoadSnapshot(self.snapshot_path, self.price_bases)
+        if snapshot is None:
+            if LOGLEVEL >= LOGINFO:
+                self.log("          No snapshot to start from, waiting for prices")
+            return
+        timelines, prices_end, allocated, age = snapshot
+        self.price_timelines = timelines
+        self.price_timeline = timelines[IMPORT_TARIFF]
+        self.prices_end = prices_end
+        self.rates_version = 1
+        self.saved_version = 1
+        self.allocated = { name: previous for (name, previous) in allocated.items() if name in self.loads }
+        self.metrics.Gauge("snapshot_age_seconds", round(age))
+        if LOGLEVEL >= LOGINFO:
+            self.log("       Restored snapshot of: " + str(self.price_timeline.count) + " slots, " +
+                     str(len(self.allocated)) + " load(s), " + str(round(age)) + "s old")
+        for (name, previous) in self.allocated.items():
+            self.set_state(self.loads[name]["threshold"], state = previous["threshold"],
+                           attributes = {"unit_of_measurement": "p/kWh", "slots": previous["slots"]})
+        self.run_in(self.Analyse, 0)
+
+
+    async def terminate(self):
+        await self.octopus.Close()
+        self.rate_store.Close()
 
 
     def VariablesChanged(self, entity, attribute, old, new, kwargs):
+        self.inputs[entity] = new
         self.Analyse({ })
 
 
-    def Analyse(self, kwargs):
+    def PriceWindow(self):
 
-        # This method runs every half hour
-        # It downloads the next 24 hours or so of per-unit cost data from Octopus,
-        #   then munges it to extract current price and minimum price
-        #   If the time is within the hour defined in UPDATE_TIMESLOT, it then finds suitable 
-        #   time slots to execute defined loads, based on the number of slots required
-        #   which are defined in two input_numbers "tesla_min_slots" and "wh_min_slots"
-        #   and sets the maximum and minimum costs in order to trigger the switches during
-        #   those time slots.
+        # Returns the range of slots to analyse, from an hour ago until 25 hours ahead,
+        #   as a tuple of (first slot, slot after the last one)
+        ts_from = datetime.now(timezone.utc) - timedelta(hours = 1)
+        ts_to = ts_from + timedelta(hours = 26)
+        return SlotFromDatetime(ts_from), SlotFromDatetime(ts_to)
+
+
+    @Timed("refresh")
+    async def Refresh(self, kwargs):
+
+        # This method runs as an async callback on AppDaemon's event loop, so waiting for Octopus
+        #   never ties up a worker thread.
+        # It tops up the rate store and, if that brought new prices, reloads them and schedules
+        #   Analyse to do the rest in a worker thread.  Then it works out when to look again.
+        #   The tariffs are all fetched at once, so the wait is that of the slowest, not the total.
+        #   If Octopus can't be reached, the prices already in the store carry on being used.
+        #   Nothing else would start it off again, so it always schedules the next look, even after
+        #   an unexpected error, which is logged and then treated like Octopus being down.
+        new_slots = 0
+        failed = False
+        try:
+            from_slot, to_slot = self.PriceWindow()
+            with self.metrics.Stage("fetch"):
+                results = await asyncio.gather(*[self.FetchRates(name, url, from_slot, to_slot) for (name, url) in self.tariffs.items()],
+                                               return_exceptions = True)
+            fetched = {}
+            for (name, result) in zip(self.tariffs, results):
+                if isinstance(result, OctopusError):
+                    self.log("Unable to fetch " + name + " rates from Octopus: " + str(result), level = "WARNING")
+                    self.metrics.Count("api_failures")
+                    self.metrics.Gauge(name + "_api_status", result.status)
+                elif isinstance(result, Exception):
+                    self.log("Unable to update " + name + " rates: " + repr(result), level = "ERROR")
+                    self.metrics.Count("refresh_errors")
+                    failed = True
+                elif isinstance(result, BaseException):
+                    raise result
+                else:
+                    count, stats = result
+                    new_slots = new_slots + count
+                    if stats is not None:
+                        fetched[name] = { "latency": round(stats["latency"] * 1000), "status": stats["status"],
+                                          "attempts": stats["attempts"], "pages": stats["pages"] }
+
+            # Report how long the calls took, including any retries.  They ran together, so the wait was
+            #   that of the slowest, which becomes the state, with each tariff's figures as attributes.
+            if len(fetched) > 0:
+                latency = max(stats["latency"] for stats in fetched.values())
+                if LOGLEVEL >= LOGINFO:
+                    self.log("      Octopus API latency: " + str(latency) + "ms for " + str(len(fetched)) + " tariff(s)")
+                await self.set_state("sensor.octopus_fetch_latency", state = latency, attributes = dict(fetched, unit_of_measurement = "ms"))
+
+            # Analyse publishes the metrics when it runs, otherwise they are published straight away.
+            #   The store is read on the first run even without new prices, in case it has more than
+            #   the snapshot, but if it has none at all, the snapshot's prices are kept.
+            if new_slots > 0 or not self.store_loaded:
+                with self.metrics.Stage("load"):
+                    rates = await self.run_in_executor(self.LoadRates, from_slot, to_slot + SLOTS_PER_DAY)
+                self.store_loaded = True
+                if len(rates[IMPORT_TARIFF]) == 0 and self.price_timeline.count > 0:
+                    self.log("No prices in the rate store, carrying on with the snapshot", level = "WARNING")
+                else:
+                    timelines = AlignedTimelines(rates)
+                    if NET_PRICES in self.price_bases:
+                        timelines[NET_PRICES] = NetTimeline(timelines[IMPORT_TARIFF], timelines[EXPORT_TARIFF])
+                    ends = [tariff_rates[-1][0] + 1 for tariff_rates in rates.values() if len(tariff_rates) > 0]
+                    self.prices_end = min(ends) if len(ends) > 0 else None
+                    self.price_timelines = timelines
+                    self.price_timeline = timelines[IMPORT_TARIFF]
+                    self.rates_version = self.rates_version + 1
+                await self.run_in(self.Analyse, 0)
+            else:
+                await self.run_in(self.PublishMetrics, 0)
+        except Exception as e:
+            self.log("Unable to refresh prices: " + repr(e), level = "ERROR")
+            self.metrics.Count("refresh_errors")
+            failed = True
+        finally:
+            await self.SchedulePoll(new_slots > 0, failed)
 
-        ts_now = (datetime.now(timezone.utc))
-        self.log(" ")
-        self.log("#########################################################################")
-        self.log("Octopus Analyse executing at: " + str(ts_now) + " UTC")
-        self.log("#########################################################################")
 
-        # set default prices
-        tesla_threshold = DEFAULT_TESLA_THRESHOLD
-        wh_threshold = DEFAULT_WH_THRESHOLD
-        current_price = DEFAULT_CURRENT_COST
+    def LoadRates(self, from_slot, to_slot):
+
+        # The (slot, price) pairs held for each tariff, from from_slot up to to_slot
+        return { name: self.rate_store.Prices(from_slot, to_slot, name) for name in self.tariffs }
 
-        # Initialise price lists.  One per device, plus one that contains all prices
-        global_price_list = []
-        tesla_price_list = []
-        wh_price_list = []
 
-        # set up DST flag
-        is_dst = self.get_state("binary_sensor.is_dst")
+    def PublishMetrics(self, kwargs):
+        self.metrics.Publish("analyse")
+
+
+    async def SchedulePoll(self, new_prices, failed = False):
+
+        # Poll again soon, backing off, while waiting for prices or after an error, or else not until
+        #   the prices held start to run out.  New prices restart the back-off, in case they are only
+        #   some of those due.
+        ts_now = datetime.now(timezone.utc)
+        if failed:
+            ts_due = ts_now
+        elif self.prices_end is not None:
+            ts_due = DatetimeFromSlot(self.prices_end).replace(tzinfo = timezone.utc) - AWAIT_PRICES
+        else:
+            ts_due = ts_now
+        if new_prices:
+            self.poll_delay = POLL_MIN_DELAY
+
+        if ts_due <= ts_now:
+            if LOGLEVEL >= LOGINFO:
+                self.log("      Waiting for prices, next check in: " + str(self.poll_delay) + "s")
+            await self.run_in(self.Refresh, self.poll_delay)
+            self.poll_delay = min(self.poll_delay * 2, POLL_MAX_DELAY)
+        else:
+            if LOGLEVEL >= LOGINFO:
+                self.log("         Next price check: " + str(ts_due.astimezone(self.zone)))
+            await self.run_at(self.Refresh, ts_due)
+            self.poll_delay = POLL_MIN_DELAY
+
+
+    async def FetchRates(self, tariff, url, from_slot, to_slot):
+
+        # Bring the rate store up to date for one tariff for the slots from from_slot up to to_slot,
+        #   and return the number of new slots, with the figures for the API call, or None if none was made.
+        #   Only the slots after the last one already held are requested from Octopus, so
+        #   most runs ask for nothing at all, or for the handful of slots published since.
+        #   The store is SQLite, so calls to it are handed to the executor rather than run on the loop.
+        last_slot = await self.run_in_executor(self.rate_store.LastSlot, tariff)
+        if last_slot is not None and last_slot + 1 > from_slot:
+            from_slot = last_slot + 1
+        if from_slot >= to_slot:
+            if LOGLEVEL >= LOGINFO:
+                self.log(("Rate store has " + tariff + ": ").rjust(27) + "up to date, no API call needed")
+            return 0, None
+
+        period_from = SlotToISO(from_slot)    # convert to and from times for API call into ISO format
+        period_to = SlotToISO(to_slot)
         if LOGLEVEL >= LOGINFO:
-            self.log("                   is_dst: " + is_dst)
-        
-        # Set current time, and the to and from times for the call to the Octopus API
-        ts_now = (datetime.now())
-        ts_from = ts_now - timedelta(hours = 1)
-        ts_to = ts_from + timedelta(hours = 26)
+            self.log((tariff + " period_from: ").rjust(27) + period_from)
+            self.log((tariff + " period_to: ").rjust(27) + period_to)
 
-        # Get the defined time slots for the devices from HA
-        tesla_start_time = datetime.strptime(self.get_state("input_datetime.tesla_start_time"), "%H:%M:%S").replace(year = ts_now.year, month = ts_now.month, day = ts_now.day)
-        tesla_stop_time = datetime.strptime(self.get_state("input_datetime.tesla_stop_time"), "%H:%M:%S").replace(year = ts_now.year, month = ts_now.month, day = ts_now.day)
-        wh_start_time = datetime.strptime(self.get_state("input_datetime.wh_start_time"), "%H:%M:%S").replace(year = ts_now.year, month = ts_now.month, day = ts_now.day)
-        wh_stop_time = datetime.strptime(self.get_state("input_datetime.wh_stop_time"), "%H:%M:%S").replace(year = ts_now.year, month = ts_now.month, day = ts_now.day)
-
-        # Adjust start and stop times into tomorrow if the time slot is in the past
-        if tesla_stop_time <= ts_now:
-            tesla_start_time = tesla_start_time + timedelta(days = 1)
-            tesla_stop_time = tesla_stop_time + timedelta(days = 1)
-        if wh_stop_time <= ts_now:
-            wh_start_time = wh_start_time + timedelta(days = 1)
-            wh_stop_time = wh_stop_time + timedelta(days = 1)
-
-        # Also adjust start times if they appear to be after the stop times (i.e. the slot straddles midnight)
-        if tesla_start_time > tesla_stop_time:
-            tesla_start_time = tesla_start_time - timedelta(days = 1)
-        if wh_start_time > wh_stop_time:
-            wh_start_time = wh_start_time - timedelta(days = 1)
-
-        period_from = ts_from.isoformat()[0:25] + "Z"    # convert to and from times for API call into ISO format
-        period_to = ts_to.isoformat()[0:25] + "Z"
+        timeslots, stats = await self.octopus.GetRates(url, period_from, period_to)    # HTTP call to Octopus API
+
+        # Record how long the call took, including any retries
+        self.metrics.Count("api_requests", stats["attempts"])
+        self.metrics.Gauge(tariff + "_api_latency_seconds", stats["latency"])
+        self.metrics.Gauge(tariff + "_api_status", stats["status"])
+        self.metrics.Gauge(tariff + "_api_attempts", stats["attempts"])
+        self.metrics.Gauge(tariff + "_api_pages", stats["pages"])
+        if LOGLEVEL >= LOGINFO:
+            self.log((tariff + " API latency: ").rjust(27) + str(round(stats["latency"] * 1000)) + "ms, HTTP " + str(stats["status"]) + ", " +
+                     str(stats["attempts"]) + " attempt(s), " + str(stats["pages"]) + " page(s)")
+
+        with self.metrics.Stage("parse"):
+            rates = list(RatesFromRecords(timeslots, from_slot, to_slot))    # keep the slot and price of each record
+        with self.metrics.Stage("store"):
+            await self.run_in_executor(self.rate_store.Store, rates, tariff)
+        self.metrics.Count("slots_downloaded", len(rates))
         if LOGLEVEL >= LOGINFO:
-            self.log("                 Time now: " + str(ts_now))
-            self.log("         tesla_start_time: " + str(tesla_start_time))
-            self.log("          tesla_stop_time: " + str(tesla_stop_time))
-            self.log("            wh_start_time: " + str(wh_start_time))
-            self.log("             wh_stop_time: " + str(wh_stop_time))
-            self.log("              Period_from: " + period_from)
-            self.log("                Period_to: " + period_to)
+            self.log(("New " + tariff + " slots: ").rjust(27) + str(len(rates)))
+        return len(rates), stats
+
+
+    def LoadFromConfig(self, name, config, ts_now):
+
+        # Build a Load for the allocator from one of the load definitions, using the user's
+        #   settings for its time window and the number of slots wanted.  The window used is
+        #   the current one, or the next if it has already finished for today.
+        start_time = TimeOfDay(self.inputs[config["start_time"]])
+        stop_time = TimeOfDay(self.inputs[config["stop_time"]])
+        window_from, window_to = NextWindow(start_time, stop_time, ts_now, self.zone)
+
+        # The number of slots wanted, or enough to deliver the energy wanted at the load's power
+        kw = float(config.get("kw", 0))
+        if "energy" in config and kw > 0:
+            energy = float(self.inputs[config["energy"]])
+            min_slots = math.ceil(energy / (kw * SLOT_SECONDS / 3600))
+        else:
+            min_slots = int(float(self.inputs[config["min_slots"]]))
+        mode = config.get("mode", MODE_CHEAPEST)
+        exact = config.get("price", IMPORT_TARIFF) != IMPORT_TARIFF
+        return Load(name, window_from, window_to, min_slots, mode, int(config.get("min_run", 1)), config.get("max_starts"), kw, exact)
+
+
+    def WithoutPrices(self, config, load, settings, window_prices):
+
+        # Publish the default threshold, without slots, for a load whose window isn't covered by the
+        #   prices, so that it runs on its time window alone, and at or below the default threshold
+        #   in any slots that do have a price (see Timeline.py).  Slots chosen for an earlier window
+        #   are dropped, so the switching apps don't keep to them.  Without prices, loads sharing a
+        #   site capacity can't be kept within it, and run on their windows like the rest.
+        previous = self.allocated.get(load.name)
+        threshold = config["default_threshold"]
+        if previous is None or previous.get("planned") or previous["threshold"] != threshold or previous["slots"] is not None:
+            if LOGLEVEL >= LOGINFO:
+                self.log(("No prices for " + load.name + ": ").rjust(27) + "running on its window, threshold " + str(threshold) + "p/kWh")
+            self.set_state(config["threshold"], state = threshold, attributes = {"unit_of_measurement": "p/kWh", "slots": None})
+        self.allocated[load.name] = { "settings": settings, "prices": window_prices, "threshold": threshold,
+                                      "slots": None, "kw": load.kw }
 
-        payload = { 'period_from' : period_from, 'period_to' : period_to }
-        r = requests.get(OCTOPUS_URL, params=payload)   # HTTP call to Octopus API
 
-        if LOGLEVEL >= LOGDEBUG:
-            self.log("Call returned HTTP code: " + str(r.status_code))
-            self.log(r.content)
-            self.log(r.json())
-
-        timeslots = r.json()["results"]    # discard the bits of the response that aren't pricing data...
-        for x in timeslots:                # ...and then loop through the bits that are
-            price = round(x["value_inc_vat"], 3)
-            start_time = iso8601.parse_date(x["valid_from"])
-            end_time = iso8601.parse_date(x["valid_to"])
-            start_time = start_time.replace(tzinfo=None)
-            end_time = end_time.replace(tzinfo=None)
-
-            # Adjust times for DST, as Octopus returns UTC times and things get messy if we try and 
-            #   use timezone information to get it right.  The is_dst flag is maintained by HA,
-            #   and reads "on" or "off", mildly irritatingly.
-            if is_dst.upper() == "ON":
-                start_time = start_time + timedelta(hours = 1)
-                end_time = end_time + timedelta(hours = 1)
-            
-            global_price_list.append(price)  # keep list of all prices
-            if (tesla_start_time <= start_time) and (tesla_stop_time >= end_time):
-                tesla_price_list.append(price)   # add to list of prices for car charging if the data point is within the right time span
-            if (wh_start_time <= start_time) and (wh_stop_time >= end_time):
-                wh_price_list.append(price)      # add to list of prices for water heater if the data point is within the right time span
-
-            if LOGLEVEL >= LOGDEBUG:
-                self.log("Start time: " + str(start_time) + "   End time: " + str(end_time) + "   Price: " + str(price) + "   Current time: " + str(ts_now))
- 
-            if (ts_now >= start_time) and (ts_now <= end_time):
-                current_price = price    # pick up the current price if this data is relevant
-                if LOGLEVEL >= LOGDEBUG:
-                    self.log("      Found current price: " + str(current_price))
+    @Timed("analyse", publish = True)
+    def Analyse(self, kwargs):
+
+        # This method runs every half hour, whenever Refresh has found new prices, and whenever
+        #   the user changes one of the loads' settings.
+        # It works from the prices Refresh has loaded, so needs neither the network nor the store.
+        #   It publishes the current and minimum prices, then finds suitable time slots to execute
+        #   each of the loads defined in apps.yaml, based on the number of slots required, which
+        #   are defined in input_numbers such as "tesla_min_slots" and "wh_min_slots", and sets the
+        #   threshold costs in order to trigger the switches during those time slots.
+        #   Only loads whose settings have changed, or whose window has new prices and hasn't
+        #   started yet, are allocated again, and only values that have changed are sent to HA.
+
+        ts_now = (datetime.now(timezone.utc))
+        self.log(" ")
+        self.log("#########################################################################")
+        self.log("Octopus Analyse executing at: " + str(ts_now) + " UTC")
+        self.log("#########################################################################")
 
-        tesla_price_list.sort()
-        wh_price_list.sort()
+        # Everything from here on works in half-hourly slots (see Slots.py), which are UTC,
+        #   so there is no need to worry about daylight saving except when reading the windows.
+        current_slot = SlotFromDatetime(ts_now)
+        if LOGLEVEL >= LOGINFO:
+            self.log("                 Time now: " + str(ts_now.astimezone(self.zone)))
+
+        # Build the price list from the prices held, and pick up the current price if there is one
+        rates_version = self.rates_version
+        timelines = self.price_timelines
+        prices_end = self.prices_end
+        timeline = timelines[IMPORT_TARIFF]
+        from_slot, to_slot = self.PriceWindow()
+        rates = timeline.Rates(from_slot, to_slot)
+        global_price_list = [price for (slot, price) in rates]
+        current_price = timeline.Price(current_slot)
+        if current_price is None:
+            current_price = DEFAULT_CURRENT_COST
+
+        self.metrics.Gauge("slots_held", timeline.count)
+        self.metrics.Gauge("slots_analysed", len(rates))
         if LOGLEVEL >= LOGDEBUG:
             self.log("             Global price list: " + str(global_price_list))
-            self.log("       Sorted Tesla price list: " + str(tesla_price_list))
-            self.log("Sorted water heater price list: " + str(wh_price_list))
-
-        if ts_now.hour == UPDATE_TIMESLOT:    # Only update start and stop prices in the defined hour, normally 18:00-19:00
-            # Calculate threshold prices
-            # Use the <xxx>_time_slots input numbers to find a price level that will give the required number of slots.
-            # The stop price is set to the start price plus a fixed hysteresis value for now, we might do something
-            # cleverer later.
-            # Note that the code block is duplicated per device, so modifications need making to all blocks
-            if len(tesla_price_list) > 0:
-                tesla_min_slots = int(float(self.get_state("input_number.tesla_min_slots")))
-                if tesla_min_slots > len(tesla_price_list):
-                    tesla_min_slots = len(tesla_price_list)
+
+        # Calculate threshold prices
+        # Use the <xxx>_min_slots input numbers to find a price level that will give the required number of slots.
+        # A load needs allocating again if its settings or window have changed, or if the prices in its window
+        # have changed before it has started, or since it was last given slots without them.  Loads whose
+        # windows aren't covered by the prices, as before the next day's prices are out or when they have run
+        # out in an outage, aren't given slots from part of the window, but run on their window (see
+        # WithoutPrices) until the prices arrive.  Each load is judged on the prices it is scheduled on.
+        # Loads with a charge plan take their slots from it instead, and when a plan changes, the loads sharing
+        # the site capacity with it are allocated again around it.  A load whose plan has been withdrawn is
+        # allocated as usual.
+        plans = { name: sorted(self.inputs[config["charge_plan"]]) for (name, config) in self.loads.items()
+                  if "charge_plan" in config and self.inputs.get(config["charge_plan"]) is not None }
+        plans_changed = any(self.allocated.get(name) is None or not self.allocated[name].get("planned") or
+                            self.allocated[name]["slots"] != slots for (name, slots) in plans.items()) or \
+                        any(allocated.get("planned") and name not in plans for (name, allocated) in self.allocated.items())
+        dirty = []
+        for (name, config) in self.loads.items():
+            load = self.LoadFromConfig(name, config, ts_now)
+            settings = (load.window_from, load.window_to, load.slots_wanted)
+            prices = timelines[config.get("price", IMPORT_TARIFF)]
+            window_prices = tuple(prices.Price(slot) for slot in range(load.window_from, load.window_to))
+            previous = self.allocated.get(name)
+            if name in plans:
+                if LOGLEVEL >= LOGINFO and plans_changed:
+                    self.log((name + " charge plan: ").rjust(27) + str(len(plans[name])) + " slots")
+                self.allocated[name] = { "settings": settings, "prices": window_prices,
+                                         "threshold": config["default_threshold"] if previous is None else previous["threshold"],
+                                         "slots": plans[name], "kw": load.kw, "planned": True }
+                continue
+            if len(window_prices) > 0 and window_prices[-1] is None:
+                self.WithoutPrices(config, load, settings, window_prices)
+                continue
+            if (previous is None or previous.get("planned") or previous["settings"] != settings or
+                    (plans_changed and self.site_capacity is not None) or
+                    (previous["prices"] != window_prices and (load.window_from > current_slot or None in previous["prices"]))):
+                dirty.append((config, load, settings, window_prices))
+
+        if len(dirty) > 0:
+            loads = [load for (config, load, settings, window_prices) in dirty]
+            for load in loads:
+                if LOGLEVEL >= LOGINFO:
+                    self.log((load.name + " start time: ").rjust(27) + str(LocalDatetimeFromSlot(load.window_from, self.zone)))
+                    self.log((load.name + " stop time: ").rjust(27) + str(LocalDatetimeFromSlot(load.window_to, self.zone)))
+                    self.log((load.name + " min slots: ").rjust(27) + str(load.slots_wanted))
+                    self.log((load.name + " mode: ").rjust(27) + load.mode)
+
+            # All the loads on the same prices are allocated their cheapest slots together, in one pass
+            # over the prices, keeping within the site capacity if there is one, less whatever is already
+            # taken by loads that aren't being allocated again, or by loads on other prices allocated first.
+            capacity = None
+            if self.site_capacity is not None:
+                capacity = { slot: self.site_capacity for (slot, price) in timeline.Rates(timeline.first_slot, timeline.end_slot) }
+                names = set(load.name for load in loads)
+                for (name, previous) in self.allocated.items():
+                    if name not in names:
+                        for slot in previous["slots"] or []:
+                            if slot in capacity:
+                                capacity[slot] = capacity[slot] - previous["kw"]
+            with self.metrics.Stage("allocate"):
+                for basis in self.price_bases:
+                    group = [load for (config, load, settings, window_prices) in dirty if config.get("price", IMPORT_TARIFF) == basis]
+                    if len(group) == 0:
+                        continue
+                    AllocateSlots(rates if basis == IMPORT_TARIFF else timelines[basis].Rates(from_slot, to_slot), group, capacity)
+                    if capacity is not None:
+                        for load in group:
+                            for (slot, price) in load.allocation:
+                                if slot in capacity:
+                                    capacity[slot] = capacity[slot] - load.kw
+            self.metrics.Count("loads_allocated", len(loads))
+
+            for (config, load, settings, window_prices) in dirty:
+                threshold = load.Threshold(HEADROOM, config["default_threshold"])
+                slots = load.Slots()
                 if LOGLEVEL >= LOGDEBUG:
-                    self.log("input_number.tesla_min_slots: " + str(tesla_min_slots))
-                if tesla_min_slots > 0:
-                    tesla_threshold = round(tesla_price_list[tesla_min_slots - 1] + HEADROOM, 3)
-            else:
-                tesla_threshold = DEFAULT_TESLA_THRESHOLD
-
-            # Calculate start/stop prices
-            # Use the <xxx>_time_slots input numbers to find a price level that will give the required number of slots.
-            # The stop price is set to the start price plus a fixed hysteresis value for now, we might do something
-            # cleverer later.
-            # Note that the code block is duplicated per device, so modifications need making to all blocks
-            if len(wh_price_list) > 0:
-                wh_min_slots = int(float(self.get_state("input_number.wh_min_slots")))
-                if wh_min_slots > len(wh_price_list):
-                    wh_min_slots = len(wh_price_list)
+                    self.log("Allocated " + load.name + " prices: " + str([price for (slot, price) in load.allocation]))
                 if LOGLEVEL >= LOGINFO:
-                    self.log("input_number.wh_min_slots: " + str(wh_min_slots))
-                if wh_min_slots > 0:
-                    wh_threshold = round(wh_price_list[wh_min_slots - 1] + HEADROOM, 3)
-            else:
-                wh_threshold = DEFAULT_WH_THRESHOLD
-
-            if LOGLEVEL >= LOGINFO:
-                self.log ("      New Tesla threshold: " + str(tesla_threshold) + "p/kWh")
-                self.log ("         New WH threshold: " + str(wh_threshold) + "p/kWh")
-            self.set_state("input_number.tesla_threshold", state=tesla_threshold, attributes = {"unit_of_measurement": "p/kWh"})
-            self.set_state("input_number.wh_threshold", state=wh_threshold, attributes = {"unit_of_measurement": "p/kWh"})
-
-        # now save current price.  Done last so that the triggers in the OctopusSwitching method 
-        # work with the start/stop values extracted above
+                    self.log(("New " + load.name + " threshold: ").rjust(27) + str(threshold) + "p/kWh")
+                if LOGLEVEL >= LOGINFO and len(load.allocation) < load.slots_wanted:
+                    self.log(("Short of " + load.name + " slots: ").rjust(27) + str(len(load.allocation)) + " of " + str(load.slots_wanted))
+                if LOGLEVEL >= LOGINFO and slots is not None:
+                    self.log((load.name + " slots: ").rjust(27) + ", ".join(str(LocalDatetimeFromSlot(slot, self.zone).time()) for slot in slots))
+
+                # Loads wanting consecutive slots, or sharing the site capacity, also get the slots themselves,
+                # for the switching apps to follow
+                previous = self.allocated.get(load.name)
+                if previous is None or previous.get("planned") or previous["threshold"] != threshold or previous["slots"] != slots:
+                    self.set_state(config["threshold"], state = threshold, attributes = {"unit_of_measurement": "p/kWh", "slots": slots})
+                self.allocated[load.name] = { "settings": settings, "prices": window_prices, "threshold": threshold,
+                                              "slots": slots, "kw": load.kw }
+
+        # Publish the prices for the switching apps to plan with, from the current slot onwards, if they have changed
+        if rates_version != self.published_version:
+            with self.metrics.Stage("publish"):
+                upcoming_rates = [[slot, price] for (slot, price) in timeline.Rates(current_slot, timeline.end_slot)]
+                self.set_state("sensor.octopus_rates", state = len(upcoming_rates), attributes = {"prices": upcoming_rates})
+            self.published_version = rates_version
+
+        # now save the minimum and current prices, along with the current prices of the other tariffs, for
+        # display in HA.  The switching apps don't use them: they plan from the price timeline and the
+        # thresholds and slots published above
+        if len(global_price_list) > 0:
+            minimum_price = min(global_price_list)
+        else:
+            minimum_price = DEFAULT_MINIMUM_COST
         if LOGLEVEL >= LOGINFO:
-            self.log ("        New minimum price: " + str(min(global_price_list)) + "p/kWh")
+            self.log ("        New minimum price: " + str(minimum_price) + "p/kWh")
             self.log ("                New price: " + str(current_price) + "p/kWh")
-        self.set_state("input_number.octopus_min_cost", state = min(global_price_list), attributes = {"unit_of_measurement": "p/kWh"})
-        self.set_state("input_number.octopus_cur_cost", state = current_price, attributes = {"unit_of_measurement": "p/kWh"})
+        other_prices = { basis: timelines[basis].Price(current_slot) for basis in self.price_bases if basis != IMPORT_TARIFF }
+        if self.published_costs != (minimum_price, current_price, other_prices):
+            self.set_state("input_number.octopus_min_cost", state = minimum_price, attributes = {"unit_of_measurement": "p/kWh"})
+            self.set_state("input_number.octopus_cur_cost", state = current_price, attributes = dict(other_prices, unit_of_measurement = "p/kWh"))
+            self.published_costs = (minimum_price, current_price, other_prices)
+
+        # Save the prices and schedule for the next start-up, whenever either has changed, unless
+        # there are no prices, so that an outage never replaces a good snapshot with an empty one
+        if self.snapshot_path and timeline.count > 0 and (len(dirty) > 0 or plans_changed or rates_version != self.saved_version):
+            try:
+                with self.metrics.Stage("snapshot"):
+                    SaveSnapshot(self.snapshot_path, timelines, prices_end, self.allocated)
+                self.saved_version = rates_version
+            except OSError as e:
+                self.log("Unable to save snapshot: " + str(e), level = "WARNING")
@@ -0,0 +1,145 @@
+import asyncio
+import random
+import time
+import aiohttp
+from Slots import SlotFromISO
+
+###############
+# Non-blocking client for the Octopus REST API
+###############
+
+# All requests go through a single aiohttp session, so the TCP/TLS connection to api.octopus.energy
+#   is kept alive and reused from one run to the next, and a small pool of connections lets several
+#   tariffs be fetched at once.  Every request is bounded by a timeout, and
+#   failures that are likely to be temporary are retried with an exponential, jittered backoff.
+OCTOPUS_API_BASE = "https://api.octopus.energy/v1/"
+
+CONNECT_TIMEOUT = 5         # seconds to establish a connection
+REQUEST_TIMEOUT = 20        # seconds for a whole request, including reading the response
+MAX_CONNECTIONS = 4         # size of the connection pool
+KEEPALIVE_TIMEOUT = 300     # seconds to keep an idle connection open; runs are 30 minutes apart at most
+
+RETRY_ATTEMPTS = 4          # total attempts per request, including the first
+RETRY_BASE_DELAY = 1.0      # seconds before the first retry, doubled for each further retry
+RETRY_MAX_DELAY = 30.0      # cap on the delay between retries
+
+# HTTP status codes worth retrying, as they normally clear by themselves
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+
+def RatesURL(product_code, tariff_code):
+    return OCTOPUS_API_BASE + "products/" + product_code + "/electricity-tariffs/" + tariff_code + "/standard-unit-rates/"
+
+
+def RatesFromRecords(records, from_slot, to_slot):
+
+    # Generator turning unit rate records from the API into (slot, price) pairs, for the slots from
+    #   from_slot up to to_slot.  Agile records each cover a single slot, but a record covering
+    #   several slots (or open-ended, with no valid_to) is spread across all of them.
+    for x in records:
+        start_slot = SlotFromISO(x["valid_from"])
+        if x.get("valid_to") is None:
+            end_slot = to_slot
+        else:
+            end_slot = SlotFromISO(x["valid_to"])
+        price = round(x["value_inc_vat"], 3)
+        for slot in range(max(start_slot, from_slot), min(end_slot, to_slot)):
+            yield (slot, price)
+
+
+class OctopusError(Exception):
+
+
+    def __init__(self, message, status = None):
+
+        # status is the HTTP status of the last attempt, or None if no response was received
+        super().__init__(message)
+        self.status = status
+
+
+class OctopusClient:
+
+
+    def __init__(self):
+
+        # The session is created on first use, as it must be created from inside the event loop
+        self.session = None
+
+
+    def Session(self):
+
+        if self.session is None or self.session.closed:
+            connector = aiohttp.TCPConnector(limit = MAX_CONNECTIONS, keepalive_timeout = KEEPALIVE_TIMEOUT)
+            timeout = aiohttp.ClientTimeout(total = REQUEST_TIMEOUT, sock_connect = CONNECT_TIMEOUT)
+            self.session = aiohttp.ClientSession(connector = connector, timeout = timeout)
+        return self.session
+
+
+    async def Close(self):
+
+        if self.session is not None and not self.session.closed:
+            await self.session.close()
+        self.session = None
+
+
+    async def GetJSON(self, url, params = None):
+
+        # GET a URL and return a tuple of (decoded JSON, statistics).  The statistics are a dict
+        #   holding the HTTP status, the number of attempts made and the total latency in seconds.
+        #   Raises OctopusError once all attempts have failed.
+        ts_start = time.perf_counter()
+        delay = RETRY_BASE_DELAY
+        attempt = 0
+        while True:
+            attempt = attempt + 1
+            status = None
+            try:
+                async with self.Session().get(url, params = params) as response:
+                    status = response.status
+                    if status == 200:
+                        data = await response.json()
+                        return data, { "status": status, "attempts": attempt, "latency": time.perf_counter() - ts_start }
+                    if status not in RETRY_STATUSES:
+                        raise OctopusError("Octopus API returned HTTP " + str(status) + " for " + url, status)
+                    error = "HTTP " + str(status)
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                error = type(e).__name__ + " " + str(e)
+
+            if attempt >= RETRY_ATTEMPTS:
+                raise OctopusError("Octopus API failed after " + str(attempt) + " attempts, last error: " + error, status)
+
+            # Full jitter, so that retries from several clients don't all land at once
+            await asyncio.sleep(random.uniform(0, delay))
+            delay = min(delay * 2, RETRY_MAX_DELAY)
+
+
+    async def GetRatePages(self, url, period_from, period_to, page_size = None):
+
+        # Async generator yielding the unit rate records between period_from and period_to one
+        #   page at a time, following the "next" links until the API runs out of pages.  Each
+        #   page is handed on as soon as it arrives, so only one page is ever held in memory.
+        #   Each item is a tuple of (list of records, request statistics from GetJSON).
+        params = { "period_from": period_from, "period_to": period_to }
+        if page_size is not None:
+            params["page_size"] = page_size
+        while url is not None:
+            data, stats = await self.GetJSON(url, params)
+            yield data["results"], stats
+            url = data.get("next")
+            params = None                   # the "next" link already includes the query string
+
+
+    async def GetRates(self, url, period_from, period_to):
+
+        # Returns the list of all unit rate records between period_from and period_to, across
+        #   however many pages the API splits them into, along with the statistics for the
+        #   whole fetch (final HTTP status, total attempts and total latency).
+        results = []
+        total = { "status": None, "attempts": 0, "latency": 0, "pages": 0 }
+        async for (page, stats) in self.GetRatePages(url, period_from, period_to):
+            results.extend(page)
+            total["status"] = stats["status"]
+            total["attempts"] = total["attempts"] + stats["attempts"]
+            total["latency"] = total["latency"] + stats["latency"]
+            total["pages"] = total["pages"] + 1
+        return results, total
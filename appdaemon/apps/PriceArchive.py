@@ -0,0 +1,193 @@
+import argparse
+import asyncio
+import mmap
+import os
+import struct
+import sys
+import time
+from array import array
+from datetime import datetime
+from Slots import SlotFromDatetime, SlotToISO
+from OctopusAPI import OctopusClient, RatesURL, RatesFromRecords
+
+###############
+# Columnar archive of historical Octopus prices
+###############
+
+# The archive is a single file holding one array of prices, indexed by slot (see Slots.py), so the
+#   price for any slot is found by arithmetic rather than searching.  A year of Agile prices is only
+#   17,520 slots, or about 140kB, and the file is memory-mapped when read, so even years of history
+#   are available for analysis in a millisecond or two.
+#
+# The file starts with a 16 byte header, the magic string below and the index of the first slot held
+#   as a little-endian 64 bit integer, followed by the prices as little-endian doubles.  Slots with no
+#   price hold NaN.
+#
+# Run this module as a script to backfill the archive from the Octopus API, for example:
+#
+#   python3 PriceArchive.py --product AGILE-18-02-21 --tariff E-1R-AGILE-18-02-21-K --from 2023-01-01 --to 2024-01-01
+ARCHIVE_MAGIC = b"OCTARCH1"
+HEADER = struct.Struct("<8sq")
+PRICE_SIZE = 8
+
+DEFAULT_ARCHIVE = "/config/appdaemon/octopus_prices.bin"
+
+# The API allows up to 1500 records per page, about a month of half-hourly prices
+BACKFILL_PAGE_SIZE = 1500
+
+
+def PriceArray(prices):
+
+    # An array of doubles, in the archive's (little-endian) byte order
+    values = array("d", prices)
+    if sys.byteorder != "little":
+        values.byteswap()
+    return values
+
+
+class PriceArchive:
+
+
+    def __init__(self, path):
+
+        self.path = path
+        self.first_slot = None
+        self.map = None
+        if os.path.exists(path):
+            with open(path, "rb") as f:
+                magic, self.first_slot = HEADER.unpack(f.read(HEADER.size))
+            if magic != ARCHIVE_MAGIC:
+                raise ValueError(path + " is not a price archive")
+
+
+    def EndSlot(self):
+
+        # The slot after the last one held, or None if the archive is empty
+        if self.first_slot is None:
+            return None
+        return self.first_slot + (os.path.getsize(self.path) - HEADER.size) // PRICE_SIZE
+
+
+    def Write(self, rates):
+
+        # Save an iterable of (slot, price) pairs into the archive, growing it as needed.
+        #   Returns the number of prices written.
+        rates = sorted(rates)
+        if len(rates) == 0:
+            return 0
+        self.Close()
+
+        if self.first_slot is None:
+            with open(self.path, "wb") as f:
+                f.write(HEADER.pack(ARCHIVE_MAGIC, rates[0][0]))
+            self.first_slot = rates[0][0]
+        elif rates[0][0] < self.first_slot:
+            self.Rebase(rates[0][0])
+
+        with open(self.path, "r+b") as f:
+            # Pad the end of the file with NaN out to the last slot being written
+            end_slot = self.EndSlot()
+            if rates[-1][0] >= end_slot:
+                f.seek(0, os.SEEK_END)
+                f.write(PriceArray([float("nan")] * (rates[-1][0] + 1 - end_slot)).tobytes())
+
+            # Then write each run of consecutive slots in one go
+            run_start = 0
+            for i in range(1, len(rates) + 1):
+                if i == len(rates) or rates[i][0] != rates[i - 1][0] + 1:
+                    f.seek(HEADER.size + (rates[run_start][0] - self.first_slot) * PRICE_SIZE)
+                    f.write(PriceArray([price for (slot, price) in rates[run_start:i]]).tobytes())
+                    run_start = i
+        return len(rates)
+
+
+    def Rebase(self, first_slot):
+
+        # Move the start of the archive back to an earlier slot, padding with NaN
+        with open(self.path, "rb") as f:
+            f.seek(HEADER.size)
+            data = f.read()
+        with open(self.path + ".tmp", "wb") as f:
+            f.write(HEADER.pack(ARCHIVE_MAGIC, first_slot))
+            f.write(PriceArray([float("nan")] * (self.first_slot - first_slot)).tobytes())
+            f.write(data)
+        os.replace(self.path + ".tmp", self.path)
+        self.first_slot = first_slot
+
+
+    def Prices(self, from_slot = None, to_slot = None):
+
+        # Returns a tuple of (first slot, prices), where prices is a read-only memoryview of doubles
+        #   mapped straight from the file, covering the slots from from_slot up to to_slot, clipped
+        #   to those held.  Missing prices are NaN.  The view is only valid until Close or Write.
+        if self.first_slot is None:
+            return from_slot, memoryview(b"").cast("d")
+        if self.map is None:
+            with open(self.path, "rb") as f:
+                self.map = mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ)
+            if sys.byteorder == "little":
+                self.view = memoryview(self.map)[HEADER.size:].cast("d")
+            else:
+                values = array("d", memoryview(self.map)[HEADER.size:].tobytes())
+                values.byteswap()
+                self.view = memoryview(values)
+        end_slot = self.first_slot + len(self.view)
+        from_slot = self.first_slot if from_slot is None else min(max(from_slot, self.first_slot), end_slot)
+        to_slot = end_slot if to_slot is None else min(max(to_slot, from_slot), end_slot)
+        return from_slot, self.view[from_slot - self.first_slot:to_slot - self.first_slot]
+
+
+    def Close(self):
+
+        # Release the memory map.  Any views previously returned by Prices must be released first.
+        if self.map is not None:
+            self.view.release()
+            self.map.close()
+            self.map = None
+
+
+async def Backfill(archive, url, from_slot, to_slot, log = print):
+
+    # Fill the archive with every price between from_slot and to_slot, walking all the pages the
+    #   API returns.  Each page is written out as soon as it arrives, so memory use stays bounded
+    #   however long the range.
+    octopus = OctopusClient()
+    total = 0
+    try:
+        async for (page, stats) in octopus.GetRatePages(url, SlotToISO(from_slot), SlotToISO(to_slot), BACKFILL_PAGE_SIZE):
+            written = archive.Write(RatesFromRecords(page, from_slot, to_slot))
+            total = total + written
+            log("Page of " + str(len(page)) + " records, " + str(written) + " slots written, " +
+                str(round(stats["latency"] * 1000)) + "ms")
+    finally:
+        await octopus.Close()
+    return total
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description = "Backfill historical Octopus unit rates into a price archive")
+    parser.add_argument("--product", required = True, help = "product code, e.g. AGILE-18-02-21")
+    parser.add_argument("--tariff", required = True, help = "tariff code, e.g. E-1R-AGILE-18-02-21-K")
+    parser.add_argument("--from", dest = "date_from", required = True, help = "first date to fetch, YYYY-MM-DD (UTC)")
+    parser.add_argument("--to", dest = "date_to", help = "date to stop at, YYYY-MM-DD (UTC), default today")
+    parser.add_argument("--archive", default = DEFAULT_ARCHIVE, help = "archive file, default " + DEFAULT_ARCHIVE)
+    args = parser.parse_args()
+
+    from_slot = SlotFromDatetime(datetime.strptime(args.date_from, "%Y-%m-%d"))
+    if args.date_to is None:
+        to_slot = SlotFromDatetime(datetime.utcnow().replace(hour = 0, minute = 0, second = 0, microsecond = 0))
+    else:
+        to_slot = SlotFromDatetime(datetime.strptime(args.date_to, "%Y-%m-%d"))
+
+    archive = PriceArchive(args.archive)
+    total = asyncio.run(Backfill(archive, RatesURL(args.product, args.tariff), from_slot, to_slot))
+
+    ts_start = time.perf_counter()
+    first_slot, prices = archive.Prices()
+    load_time = time.perf_counter() - ts_start
+    held = sum(1 for price in prices if price == price)     # NaN is never equal to itself
+    print(str(total) + " slots written, archive now holds " + str(held) + " prices in " + str(len(prices)) +
+          " slots, loaded in " + str(round(load_time * 1000, 2)) + "ms")
+    prices.release()
+    archive.Close()
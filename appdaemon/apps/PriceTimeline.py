@@ -0,0 +1,154 @@
+import heapq
+from array import array
+
+###############
+# Read-only timeline of half-hourly prices, shared in-process by the apps
+###############
+
+# OctopusAnalysis builds a new PriceTimeline whenever it loads new prices, and other apps get it
+#   with get_app("OctopusAnalysis").price_timeline, rather than reading prices back through HA.
+#   A timeline is never changed once built, so it can be read from any thread; new prices simply
+#   mean a new timeline.
+#
+# Prices are held in an array, one per slot from first_slot, NaN where there is no price, so
+#   looking up a slot is just an index.  A sparse table holds, for each power of two 2^k and each
+#   position, the position of the cheapest slot in the 2^k slots starting there.  Any range is
+#   covered by two (overlapping) such blocks, so the cheapest slot in a range is found in O(1).
+#   The k cheapest slots in a range come from a heap of ranges: take the cheapest slot of the
+#   range at the top, then push the two ranges either side of it, so k slots cost O(k log k)
+#   however long the range.  Ties go to the earlier slot, as in SlotAllocation.
+#
+# With more than one tariff (see Octopus.py), there is a timeline for each, all built over the same
+#   slots by AlignedTimelines, so that a position means the same slot in every one of them.  Prices
+#   derived from several tariffs, such as the import price less the export price, are then just
+#   arithmetic on the arrays, with NaN wherever any of the prices is missing.
+NAN = float("nan")
+INF = float("inf")
+
+
+class PriceTimeline:
+
+
+    def __init__(self, first_slot, prices):
+
+        # prices is a sequence of prices for consecutive slots from first_slot, None or NaN where missing
+        self.first_slot = first_slot
+        self.prices = array("d", (NAN if price is None else price for price in prices))
+        self.end_slot = first_slot + len(self.prices)
+
+        # The sparse table, on prices with missing ones counted as infinitely dear
+        keys = [INF if price != price else price for price in self.prices]
+        self.count = sum(1 for key in keys if key != INF)
+        self.keys = keys
+        level = list(range(len(keys)))
+        self.table = [level]
+        width = 1
+        while width * 2 <= len(keys):
+            below = level
+            level = [below[i] if keys[below[i]] <= keys[below[i + width]] else below[i + width]
+                     for i in range(len(keys) - width * 2 + 1)]
+            self.table.append(level)
+            width = width * 2
+
+
+    def Price(self, slot):
+
+        # The price for a slot, or None if there isn't one
+        if self.first_slot <= slot < self.end_slot:
+            price = self.prices[slot - self.first_slot]
+            if price == price:
+                return price
+        return None
+
+
+    def Rates(self, from_slot, to_slot):
+
+        # The (slot, price) pairs held for the slots from from_slot up to to_slot, in slot order
+        first = max(from_slot, self.first_slot) - self.first_slot
+        last = min(to_slot, self.end_slot) - self.first_slot
+        return [(self.first_slot + i, self.prices[i]) for i in range(first, last) if self.prices[i] == self.prices[i]]
+
+
+    def MinimumPosition(self, first, last):
+
+        # Position of the cheapest price from position first up to last, which mustn't be empty
+        level = (last - first).bit_length() - 1
+        left = self.table[level][first]
+        right = self.table[level][last - (1 << level)]
+        return left if self.keys[left] <= self.keys[right] else right
+
+
+    def Minimum(self, from_slot, to_slot):
+
+        # The cheapest (slot, price) from from_slot up to to_slot, or None if there are no prices there
+        first = max(from_slot, self.first_slot) - self.first_slot
+        last = min(to_slot, self.end_slot) - self.first_slot
+        if first >= last:
+            return None
+        position = self.MinimumPosition(first, last)
+        if self.keys[position] == INF:
+            return None
+        return (self.first_slot + position, self.prices[position])
+
+
+    def Cheapest(self, count, from_slot, to_slot, exclude = None):
+
+        # The count cheapest (slot, price) pairs from from_slot up to to_slot, cheapest first,
+        #   passing over any slots in exclude, a set
+        first = max(from_slot, self.first_slot) - self.first_slot
+        last = min(to_slot, self.end_slot) - self.first_slot
+        cheapest = []
+        heap = []
+        if first < last:
+            position = self.MinimumPosition(first, last)
+            heap.append((self.keys[position], position, first, last))
+        while len(heap) > 0 and len(cheapest) < count:
+            key, position, first, last = heapq.heappop(heap)
+            if key == INF:
+                break                   # only missing prices left
+            if exclude is None or self.first_slot + position not in exclude:
+                cheapest.append((self.first_slot + position, self.prices[position]))
+            for (low, high) in ((first, position), (position + 1, last)):
+                if low < high:
+                    below = self.MinimumPosition(low, high)
+                    heapq.heappush(heap, (self.keys[below], below, low, high))
+        return cheapest
+
+
+def TimelineFromRates(rates):
+
+    # Build a PriceTimeline from a list of (slot, price) pairs in slot order
+    if len(rates) == 0:
+        return PriceTimeline(0, [])
+    first_slot = rates[0][0]
+    prices = [None] * (rates[-1][0] - first_slot + 1)
+    for (slot, price) in rates:
+        prices[slot - first_slot] = price
+    return PriceTimeline(first_slot, prices)
+
+
+def AlignedTimelines(rates):
+
+    # Build a PriceTimeline for each of a dict of name: list of (slot, price) pairs in slot order,
+    #   all covering the same slots, from the first slot any of them has to the last
+    ends = [(tariff_rates[0][0], tariff_rates[-1][0] + 1) for tariff_rates in rates.values() if len(tariff_rates) > 0]
+    if len(ends) == 0:
+        return { name: PriceTimeline(0, []) for name in rates }
+    first_slot = min(first for (first, end) in ends)
+    end_slot = max(end for (first, end) in ends)
+    timelines = {}
+    for (name, tariff_rates) in rates.items():
+        prices = [None] * (end_slot - first_slot)
+        for (slot, price) in tariff_rates:
+            prices[slot - first_slot] = price
+        timelines[name] = PriceTimeline(first_slot, prices)
+    return timelines
+
+
+def NetTimeline(import_timeline, export_timeline):
+
+    # The import price less the export price for each slot of two aligned timelines, for slots
+    #   where both are known.  Rounded, so that prices which should tie still do.
+    return PriceTimeline(import_timeline.first_slot,
+                         [round(bought - sold, 4) if bought == bought and sold == sold else NAN
+                          for (bought, sold) in zip(import_timeline.prices, export_timeline.prices)])
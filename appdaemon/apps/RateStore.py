@@ -0,0 +1,64 @@
+import sqlite3
+import threading
+
+###############
+# Persistent local store of Octopus unit rates
+###############
+
+# Rates are held in a small SQLite database, one row per tariff and half-hourly slot (see Slots.py for
+#   the slot index).  Agile prices do not change once they are published, so anything already in the
+#   store never needs downloading again, and the store survives AppDaemon restarts.
+#
+# Tariffs are identified by the names given them in apps.yaml (see Octopus.py).
+DEFAULT_TARIFF = "import"
+
+
+class RateStore:
+
+
+    def __init__(self, path):
+
+        self.path = path
+
+        # AppDaemon may call us from more than one worker thread, so share a single connection
+        #   and serialise access to it.
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread = False)
+        with self.lock:
+            self.db.execute("CREATE TABLE IF NOT EXISTS prices (tariff TEXT NOT NULL, slot INTEGER NOT NULL, "
+                            "price REAL NOT NULL, PRIMARY KEY (tariff, slot)) WITHOUT ROWID")
+            self.db.commit()
+
+
+    def Close(self):
+
+        with self.lock:
+            self.db.close()
+
+
+    def LastSlot(self, tariff = DEFAULT_TARIFF):
+
+        # Returns the index of the latest slot held for a tariff, or None if there are none.
+        with self.lock:
+            row = self.db.execute("SELECT MAX(slot) FROM prices WHERE tariff = ?", (tariff,)).fetchone()
+        return row[0]
+
+
+    def Store(self, rates, tariff = DEFAULT_TARIFF):
+
+        # Save an iterable of (slot, price) pairs for a tariff, replacing any existing prices for
+        #   those slots.  Returns the number of rows written.
+        with self.lock:
+            cursor = self.db.executemany("INSERT OR REPLACE INTO prices (tariff, slot, price) VALUES (?, ?, ?)",
+                                         ((tariff, slot, price) for (slot, price) in rates))
+            self.db.commit()
+        return cursor.rowcount
+
+
+    def Prices(self, from_slot, to_slot, tariff = DEFAULT_TARIFF):
+
+        # Returns a list of (slot, price) pairs for all held slots of a tariff from from_slot up to,
+        #   but not including, to_slot, in time order.
+        with self.lock:
+            return self.db.execute("SELECT slot, price FROM prices WHERE tariff = ? AND slot >= ? AND slot < ? ORDER BY slot",
+                                   (tariff, from_slot, to_slot)).fetchall()
@@ -0,0 +1,256 @@
+import heapq
+from bisect import bisect_left
+
+###############
+# Cheapest-slot allocation for any number of loads
+###############
+
+# Each load has a window, expressed as a range of slot indices (see Slots.py), and wants a number
+#   of slots within that window.  All the prices are sorted once, then walked from cheapest to
+#   dearest, handing each slot to every load whose window contains it and that still wants more.
+#   This gives every load exactly the slots it would get by sorting its own window's prices and
+#   taking the first n, but in a single pass however many loads there are.
+#
+# Taking the cheapest slots wherever they fall can leave a load switching on and off every half
+#   hour, which wears relays and, for the car, costs a wake-up each time charging restarts.  So a
+#   load can instead ask for:
+#   - "block": the cheapest run of consecutive slots, found with a sliding window over the prices
+#     in its window, in a single pass;
+#   - "runs": the cheapest set of slots in which every run of consecutive slots is at least
+#     min_run long, with at most max_starts runs, found by dynamic programming over the window.
+#   These loads are allocated one at a time, as their choices can't be read off a single sorted list.
+#
+# Loads can also share a supply limit, such as the main fuse or an import cap.  Each load then has
+#   a power in kW, and the loads running in any slot mustn't add up to more than the site capacity.
+#   Loads wanting consecutive slots are placed first, in the order given, in the slots that still
+#   have room for them.  The rest share out what is left with a heap-based greedy allocation:
+#   the heap holds each load's cheapest remaining candidate slot, and the cheapest of these is
+#   taken if it has room, or skipped if not.  When several loads want the same slot at the same
+#   price, the one with the fewest spare candidates goes first, as it has least to fall back on.
+#   Shared loads run in exactly the slots they are given, rather than on a threshold, as a
+#   threshold would let them run together in slots there is only room for one of them in.
+MODE_CHEAPEST = "cheapest"
+MODE_BLOCK = "block"
+MODE_RUNS = "runs"
+MODES = (MODE_CHEAPEST, MODE_BLOCK, MODE_RUNS)
+
+
+class Load:
+
+
+    def __init__(self, name, window_from, window_to, slots_wanted, mode = MODE_CHEAPEST, min_run = 1, max_starts = None,
+                 kw = 0, exact = False):
+
+        # name          - label used in logging
+        # window_from   - first slot the load may run in
+        # window_to     - the slot after the last one the load may run in
+        # slots_wanted  - number of slots to allocate
+        # mode          - how to choose the slots, one of MODES
+        # min_run       - shortest run of consecutive slots allowed, for MODE_RUNS
+        # max_starts    - most runs allowed, or None for no limit, for MODE_RUNS
+        # kw            - power drawn when running, counted against the site capacity
+        # exact         - True if the load must run in exactly its allocated slots, as when they
+        #                 are chosen on prices other than those its threshold is compared with
+        if mode not in MODES:
+            raise ValueError("Unknown allocation mode for " + name + ": " + str(mode))
+        self.name = name
+        self.window_from = window_from
+        self.window_to = window_to
+        self.slots_wanted = slots_wanted
+        self.mode = mode
+        self.min_run = max(1, min_run)
+        self.max_starts = max_starts
+        self.kw = kw
+        self.exact = exact
+
+        # Filled in by AllocateSlots: the (slot, price) pairs chosen, cheapest first, and whether
+        #   the load shares a site capacity with others
+        self.allocation = []
+        self.shared = False
+
+
+    def Threshold(self, headroom, default):
+
+        # The price at or below which the load should run to use the allocated slots.  This is
+        #   the dearest allocated price plus a little headroom, or the default if nothing was allocated.
+        if len(self.allocation) == 0:
+            return default
+        return round(self.allocation[-1][1] + headroom, 3)
+
+
+    def Slots(self):
+
+        # The allocated slots, in time order, for loads that must run in exactly those slots.
+        #   Returns None for loads in MODE_CHEAPEST that don't share a site capacity and aren't
+        #   exact, as the threshold alone picks out their slots, and if nothing was allocated, so
+        #   that the default threshold applies as usual.
+        if (self.mode == MODE_CHEAPEST and not self.shared and not self.exact) or len(self.allocation) == 0:
+            return None
+        return sorted(slot for (slot, price) in self.allocation)
+
+
+def WindowPrices(prices, load):
+
+    # The prices in the load's window, in slot order, with None for slots without a price
+    return [prices.get(slot) for slot in range(load.window_from, load.window_to)]
+
+
+def CheapestBlock(prices, load):
+
+    # The cheapest run of slots_wanted consecutive priced slots in the load's window, keeping a
+    #   running total over a sliding window which restarts after any slot without a price.  If the
+    #   window holds no run that long, the longest run there is will do, so the load isn't left out.
+    window = WindowPrices(prices, load)
+    length = min(load.slots_wanted, len(window))
+    while length > 0:
+        best = None
+        total = 0
+        run = 0
+        for (i, price) in enumerate(window):
+            if price is None:
+                total = 0
+                run = 0
+                continue
+            total = total + price
+            run = run + 1
+            if run > length:
+                total = total - window[i - length]
+                run = length
+            if run == length and (best is None or total < best[0]):
+                best = (total, i - length + 1)
+        if best is not None:
+            first = load.window_from + best[1]
+            return [(slot, prices[slot]) for slot in range(first, first + length)]
+        length = length - 1
+    return []
+
+
+def CheapestRuns(prices, load):
+
+    # The cheapest choice of slots_wanted slots in the load's window, where every run of
+    #   consecutive slots is at least min_run long and there are at most max_starts runs.
+    #   The state after each slot is (slots chosen, runs started, length of the current run,
+    #   capped at min_run, 0 if off), and only the cheapest way of reaching each state is kept.
+    #   If slots_wanted can't be met, as many slots as can be are chosen.
+    window = WindowPrices(prices, load)
+    wanted = min(load.slots_wanted, len(window))
+    max_starts = load.max_starts if load.max_starts is not None else wanted
+    min_run = load.min_run
+
+    states = {(0, 0, 0): (0, None)}       # state: (cost, (previous state, slot on or None))
+    history = []
+    for (i, price) in enumerate(window):
+        next_states = {}
+
+        def Reach(state, cost, back):
+            if state not in next_states or cost < next_states[state][0]:
+                next_states[state] = (cost, back)
+
+        for ((chosen, starts, run), (cost, back)) in states.items():
+            if run == 0 or run >= min_run:
+                Reach((chosen, starts, 0), cost, ((chosen, starts, run), None))
+            if price is not None and chosen < wanted:
+                if run == 0:
+                    if starts < max_starts:
+                        Reach((chosen + 1, starts + 1, 1), cost + price, ((chosen, starts, run), i))
+                else:
+                    Reach((chosen + 1, starts, min(run + 1, min_run)), cost + price, ((chosen, starts, run), i))
+        history.append(next_states)
+        states = next_states
+
+    finished = [(state, cost) for (state, (cost, back)) in states.items() if state[2] == 0 or state[2] >= min_run]
+    if len(finished) == 0:
+        return []
+    state = min(finished, key = lambda item: (-item[0][0], item[1]))[0]
+    if state[0] == 0:
+        return []
+
+    # Follow the choices back from the end of the window
+    slots = []
+    for next_states in reversed(history):
+        state, i = next_states[state][1]
+        if i is not None:
+            slots.append(load.window_from + i)
+    return [(slot, prices[slot]) for slot in reversed(slots)]
+
+
+def SharedSlots(rates, loads, capacity):
+
+    # Allocate the loads in MODE_CHEAPEST, sharing the capacity left in each slot (a dict of
+    #   slot: kW, where slots not present have no limit).  rates must be in slot order.
+    slots = [slot for (slot, price) in rates]
+    heap = []
+    candidates = []
+    for (index, load) in enumerate(loads):
+        first = bisect_left(slots, load.window_from)
+        last = bisect_left(slots, load.window_to)
+        candidates.append(sorted(rates[first:last], key = lambda rate: (rate[1], rate[0])))
+        if len(candidates[index]) > 0:
+            slack = len(candidates[index]) - load.slots_wanted
+            heapq.heappush(heap, (candidates[index][0][1], slack, index, 0))
+
+    while len(heap) > 0:
+        price, slack, index, position = heapq.heappop(heap)
+        load = loads[index]
+        slot = candidates[index][position][0]
+        if capacity.get(slot, load.kw) >= load.kw:
+            load.allocation.append((slot, price))
+            if slot in capacity:
+                capacity[slot] = capacity[slot] - load.kw
+        position = position + 1
+        wanted = load.slots_wanted - len(load.allocation)
+        if wanted > 0 and position < len(candidates[index]):
+            slack = len(candidates[index]) - position - wanted
+            heapq.heappush(heap, (candidates[index][position][1], slack, index, position))
+
+
+def AllocateSlots(rates, loads, capacity = None):
+
+    # rates is a list of (slot, price) pairs, in any order, and loads a list of Load objects.
+    #   capacity, if given, is the site capacity in kW shared by all the loads, either the same
+    #   for every slot, or a dict of slot: kW, where slots not present have no limit.
+    #   Fills in the allocation of each load, and returns the loads.
+    for load in loads:
+        load.allocation = []
+        load.shared = capacity is not None
+    active = [load for load in loads if load.slots_wanted > 0 and load.window_from < load.window_to]
+
+    if capacity is not None:
+        if isinstance(capacity, dict):
+            capacity = dict(capacity)
+        else:
+            capacity = { slot: capacity for (slot, price) in rates }
+
+    # Loads wanting consecutive slots are allocated on their own, cheapest slot first like the rest
+    prices = None
+    for load in [load for load in active if load.mode != MODE_CHEAPEST]:
+        if prices is None or capacity is not None:
+            prices = { slot: price for (slot, price) in rates if capacity is None or capacity.get(slot, load.kw) >= load.kw }
+        if load.mode == MODE_BLOCK:
+            allocation = CheapestBlock(prices, load)
+        else:
+            allocation = CheapestRuns(prices, load)
+        load.allocation = sorted(allocation, key = lambda rate: (rate[1], rate[0]))
+        if capacity is not None:
+            for (slot, price) in allocation:
+                if slot in capacity:
+                    capacity[slot] = capacity[slot] - load.kw
+    active = [load for load in active if load.mode == MODE_CHEAPEST]
+
+    if capacity is not None:
+        SharedSlots(sorted(rates), active, capacity)
+        return loads
+
+    for (slot, price) in sorted(rates, key = lambda rate: (rate[1], rate[0])):
+        if len(active) == 0:
+            break                       # everyone has what they wanted
+        satisfied = False
+        for load in active:
+            if load.window_from <= slot < load.window_to:
+                load.allocation.append((slot, price))
+                if len(load.allocation) >= load.slots_wanted:
+                    satisfied = True
+        if satisfied:
+            active = [load for load in active if len(load.allocation) < load.slots_wanted]
+
+    return loads
@@ -0,0 +1,138 @@
+from datetime import date
+from datetime import datetime
+from datetime import timedelta
+from functools import lru_cache
+import iso8601
+
+###############
+# Half-hourly slot arithmetic shared by the Octopus apps
+###############
+
+# Octopus Agile prices change every half hour, on the hour and on the half hour (UTC).  Rather than
+#   pass datetimes around, prices are keyed by an integer "slot index", which is simply the number
+#   of complete half hours since the Unix epoch.  Slot 0 starts at 1970-01-01 00:00:00 UTC, and the
+#   slot after slot n is always n + 1, so ranges of slots can be handled with plain arithmetic.
+#
+# Everything inside the apps works in slots, which are always UTC.  Local time only comes into it
+#   at the edges, when turning the daily time windows set in HA into ranges of slots, and when
+#   logging, and then zoneinfo does the conversion, so the clock changes are handled properly.
+SLOT_SECONDS = 1800
+SLOT_LENGTH = timedelta(seconds = SLOT_SECONDS)
+SLOTS_PER_DAY = 48
+
+EPOCH = datetime(1970, 1, 1)
+EPOCH_ORDINAL = EPOCH.toordinal()
+
+
+def Seconds(dt):
+
+    # Seconds since the epoch.  Naive datetimes are taken to be UTC.
+    if dt.tzinfo is not None:
+        return dt.timestamp()
+    return (dt - EPOCH).total_seconds()
+
+
+def SlotFromDatetime(dt):
+
+    # Convert a datetime to the index of the slot containing it.  Naive datetimes are taken to be UTC.
+    return int(Seconds(dt) // SLOT_SECONDS)
+
+
+def DatetimeFromSlot(slot):
+
+    # Convert a slot index back to the (naive, UTC) datetime at which the slot starts.
+    return EPOCH + timedelta(seconds = slot * SLOT_SECONDS)
+
+
+def LocalDatetimeFromSlot(slot, zone):
+
+    # The local time at which a slot starts, in the given ZoneInfo time zone
+    return datetime.fromtimestamp(slot * SLOT_SECONDS, zone)
+
+
+@lru_cache(maxsize = 1024)
+def DayNumber(year, month, day):
+    return date(year, month, day).toordinal() - EPOCH_ORDINAL
+
+
+def SlotFromISO(text):
+
+    # Convert a timestamp from the Octopus API to a slot index.  The API always uses the same
+    #   format, "2021-03-01T13:30:00Z", which is picked apart directly rather than parsed; the day
+    #   number is cached, as a run of records only covers a handful of days.  Anything else is
+    #   handed to iso8601.
+    if len(text) == 20 and text[19] == "Z" and text[10] == "T":
+        return ((DayNumber(int(text[0:4]), int(text[5:7]), int(text[8:10])) * SLOTS_PER_DAY) +
+                int(text[11:13]) * 2 + int(text[14:16]) // 30)
+    return SlotFromDatetime(iso8601.parse_date(text))
+
+
+def SlotRange(start_dt, stop_dt):
+
+    # Returns the range of slots lying wholly between two datetimes (naive ones are taken to be UTC),
+    #   as a tuple of (first slot, slot after the last one).  The range is empty if no whole slot fits.
+    first = -int(-Seconds(start_dt) // SLOT_SECONDS)
+    end = int(Seconds(stop_dt) // SLOT_SECONDS)
+    return first, max(first, end)
+
+
+def WindowOccurrence(stop_day, start, stop, zone):
+
+    # The range of slots wholly inside the occurrence of a daily window that ends on stop_day (a
+    #   local date).  start and stop are in minutes past midnight, local time; if start is after
+    #   stop, the window straddles midnight and starts the day before.
+    if start > stop:
+        start_day = stop_day - timedelta(days = 1)
+    else:
+        start_day = stop_day
+    start_dt = datetime(start_day.year, start_day.month, start_day.day, start // 60, start % 60, tzinfo = zone)
+    stop_dt = datetime(stop_day.year, stop_day.month, stop_day.day, stop // 60, stop % 60, tzinfo = zone)
+    return SlotRange(start_dt, stop_dt)
+
+
+def NextWindow(start, stop, ts_now, zone):
+
+    # The range of slots in the current or next occurrence of a daily window, i.e. the first
+    #   occurrence that hasn't ended by ts_now (an aware datetime).
+    local_now = ts_now.astimezone(zone)
+    stop_day = local_now.date()
+    stop_dt = datetime(stop_day.year, stop_day.month, stop_day.day, stop // 60, stop % 60, tzinfo = zone)
+    if stop_dt <= local_now:
+        stop_day = stop_day + timedelta(days = 1)
+    return WindowOccurrence(stop_day, start, stop, zone)
+
+
+def NextTimeSlot(minutes, ts_now, zone):
+
+    # The slot containing the next occurrence, after ts_now (an aware datetime), of a local time
+    #   of day, in minutes past midnight.  The slots before it all end by that time.
+    local_now = ts_now.astimezone(zone)
+    day = local_now.date()
+    ts_next = datetime(day.year, day.month, day.day, minutes // 60, minutes % 60, tzinfo = zone)
+    if ts_next <= local_now:
+        day = day + timedelta(days = 1)
+        ts_next = datetime(day.year, day.month, day.day, minutes // 60, minutes % 60, tzinfo = zone)
+    return SlotFromDatetime(ts_next)
+
+
+def WindowRanges(start, stop, from_slot, to_slot, zone):
+
+    # All the occurrences of a daily window that overlap the slots from from_slot up to to_slot,
+    #   in time order, as a list of (first slot, slot after the last one) clipped to that range.
+    ranges = []
+    day = LocalDatetimeFromSlot(from_slot, zone).date()
+    last_day = LocalDatetimeFromSlot(to_slot, zone).date() + timedelta(days = 1)
+    while day <= last_day:
+        window_from, window_to = WindowOccurrence(day, start, stop, zone)
+        window_from = max(window_from, from_slot)
+        window_to = min(window_to, to_slot)
+        if window_from < window_to:
+            ranges.append((window_from, window_to))
+        day = day + timedelta(days = 1)
+    return ranges
+
+
+def SlotToISO(slot):
+
+    # Format the start of a slot the way the Octopus API expects its period_from/period_to parameters.
+    return DatetimeFromSlot(slot).isoformat() + "Z"
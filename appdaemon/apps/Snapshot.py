@@ -0,0 +1,62 @@
+import json
+import os
+import time
+from PriceTimeline import PriceTimeline
+
+###############
+# Snapshot of OctopusAnalysis's prices and schedule, for a fast start after a restart
+###############
+
+# After each run that changes anything, OctopusAnalysis writes its price timelines and what it has
+#   allocated to each load to a small JSON file, and reads it back first thing in initialize.  The
+#   apps can then switch correctly straight away after a restart, without waiting for the rate store
+#   or the Octopus API, and carry on with the last schedule if Octopus can't be reached.
+#
+# The file is written to a temporary file and renamed into place, so a restart part way through
+#   writing it leaves the previous snapshot intact.  A snapshot that is missing, unreadable or from
+#   an older format is ignored, and the apps start from the rate store as before.
+SNAPSHOT_FORMAT = 1
+
+
+def SaveSnapshot(path, timelines, prices_end, allocated):
+
+    # timelines  - dict of name: PriceTimeline, all aligned on the same slots
+    # prices_end - the slot after the last one every tariff has a price for, or None
+    # allocated  - dict of load name: what was last allocated to it, as kept by OctopusAnalysis
+    first_slot = next(iter(timelines.values())).first_slot
+    snapshot = {
+        "format": SNAPSHOT_FORMAT,
+        "saved": time.time(),
+        "first_slot": first_slot,
+        "prices_end": prices_end,
+        "prices": { name: [price if price == price else None for price in timeline.prices]
+                    for (name, timeline) in timelines.items() },
+        "allocated": { name: dict(previous, settings = list(previous["settings"]), prices = list(previous["prices"]))
+                       for (name, previous) in allocated.items() },
+    }
+    with open(path + ".tmp", "w") as f:
+        json.dump(snapshot, f, separators = (",", ":"))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(path + ".tmp", path)
+
+
+def LoadSnapshot(path, names):
+
+    # Returns (timelines, prices_end, allocated, seconds since it was saved) from the snapshot at
+    #   path, or None if there isn't a usable one.  names are the timelines wanted; any not in the
+    #   snapshot, as when a tariff has been added since, are given no prices.
+    try:
+        with open(path) as f:
+            snapshot = json.load(f)
+        if snapshot.get("format") != SNAPSHOT_FORMAT:
+            return None
+        first_slot = snapshot["first_slot"]
+        prices = snapshot["prices"]
+        length = max((len(tariff_prices) for tariff_prices in prices.values()), default = 0)
+        timelines = { name: PriceTimeline(first_slot, prices.get(name) or [None] * length) for name in names }
+        allocated = { name: dict(previous, settings = tuple(previous["settings"]), prices = tuple(previous["prices"]))
+                      for (name, previous) in snapshot["allocated"].items() }
+        return timelines, snapshot["prices_end"], allocated, time.time() - snapshot["saved"]
+    except (OSError, ValueError, KeyError, TypeError, AttributeError):
+        return None
@@ -0,0 +1,77 @@
+from Slots import SLOTS_PER_DAY, WindowRanges
+
+###############
+# On/off timelines for the switching apps
+###############
+
+# Rather than working out whether a device should be on every time something changes, the
+#   switching apps work out a whole timeline in one go, from the current slot to the end of the
+#   prices published by OctopusAnalysis.  The timeline is a list of (slot, state) pairs, one for
+#   each point at which the device should change state, so the apps only need a timer per change.
+#
+# Loads allocated in "block" or "runs" mode (see SlotAllocation.py) have their chosen slots
+#   published alongside the threshold, and then run in exactly those slots, as other slots in the
+#   window at or below the threshold would break up the runs they were chosen for.  Devices that
+#   choose their own slots, such as a car charging to a target by its departure time, use
+#   SlotTimeline instead.
+#
+# If the prices run out, as when Octopus can't be reached for more than a day, a device on a
+#   threshold carries on running in its time window for the slots without a price, rather than
+#   never running at all, and the timeline reaches at least a day ahead so that the next window
+#   is covered.
+
+
+def TimeOfDay(value):
+
+    # Convert an input_datetime state ("HH:MM:SS") to minutes past midnight
+    fields = value.split(":")
+    return int(fields[0]) * 60 + int(fields[1])
+
+
+def BuildTimeline(rates, threshold, start, stop, zone, from_slot, slots = None):
+
+    # rates is a list of (slot, price) pairs, threshold the price at or below which the device
+    #   should run, start and stop the daily window in minutes past midnight local time, and zone
+    #   the local ZoneInfo time zone.  If slots is given, the device runs in those slots instead
+    #   of wherever the price is low enough, and otherwise it runs in any slot of the window without
+    #   a price.  Returns the timeline from from_slot onwards, to the end of the prices or a day
+    #   ahead, whichever is later; the last change is always to "off".
+    prices = dict(rates)
+    if slots is not None:
+        slots = set(slots)
+    last_slot = max(max(prices) if len(prices) > 0 else from_slot, from_slot + SLOTS_PER_DAY - 1)
+    windows = WindowRanges(start, stop, from_slot, last_slot + 1, zone)
+    timeline = []
+    state = None
+    window = 0
+    for slot in range(from_slot, last_slot + 2):
+        while window < len(windows) and windows[window][1] <= slot:
+            window = window + 1
+        in_window = window < len(windows) and windows[window][0] <= slot
+        price = prices.get(slot)
+        if slots is not None:
+            wanted = slot in slots
+        else:
+            wanted = (price is None) or (price <= threshold)
+        if in_window and wanted:
+            new_state = "on"
+        else:
+            new_state = "off"
+        if new_state != state:
+            timeline.append((slot, new_state))
+            state = new_state
+    return timeline
+
+
+def SlotTimeline(slots, from_slot):
+
+    # The timeline, from from_slot onwards, of a device running in exactly the given slots (a set)
+    timeline = [(from_slot, "on" if from_slot in slots else "off")]
+    for slot in sorted(slots):
+        if slot < from_slot:
+            continue
+        if slot > from_slot and (slot - 1) not in slots:
+            timeline.append((slot, "on"))
+        if (slot + 1) not in slots:
+            timeline.append((slot + 1, "off"))
+    return timeline
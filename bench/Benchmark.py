@@ -0,0 +1,368 @@
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+import time
+from datetime import datetime
+from datetime import timezone
+
+###############
+# Benchmarks for the Octopus apps, run against a mock Octopus API and a fake Home Assistant
+###############
+
+# Run from anywhere with:
+#
+#   python3 bench/Benchmark.py
+#
+# The apps need aiohttp and iso8601, as they do under AppDaemon, but nothing else: the hassapi
+#   module they import is replaced by FakeHass, and the Octopus API by MockOctopus.
+#
+# Two sets of timings are reported:
+#   - the pipeline stages (fetch, parse, store, select, publish) over horizons from a day to a
+#     year, calling the same functions the apps use, with as many loads as there are days, and
+#     twice as many sharing a site capacity for the "shared" selection;
+#   - the apps themselves end to end: OctopusAnalysis Refresh with an empty and a warm rate store,
+#     Analyse with and without a change to the settings, initialize from a snapshot, and the TeslaSwitching and
+#     ImmersionSwitching plans, with the number of HA calls each makes;
+#   - many devices switched by one LoadSwitching app, compared with one app per device;
+#   - the price timeline queries, against a year of prices, compared with sorting the same range;
+#   - fetching several tariffs from a slow API one after another, and all at once, as Refresh does.
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(os.path.dirname(BENCH_DIR), "appdaemon", "apps"))
+sys.path.insert(0, BENCH_DIR)
+
+import FakeHass
+sys.modules["hassapi"] = FakeHass
+
+import OctopusAPI
+import Octopus
+import Tesla
+import Immersion
+import LoadSwitching
+from Slots import SlotFromDatetime, DatetimeFromSlot
+from RateStore import RateStore
+from SlotAllocation import Load, AllocateSlots
+from PriceTimeline import PriceTimeline
+from MockOctopus import MockOctopusServer, MockPrice
+
+HORIZONS = [1, 7, 30, 365]
+
+# Number of devices switched in the comparison of one LoadSwitching app with one app per device
+DEVICES = 20
+
+# The tariffs the apps are run with: Agile import and export for one region, and import for two more
+BENCH_TARIFFS = {
+    "import": ("AGILE-18-02-21", "E-1R-AGILE-18-02-21-K"),
+    "export": ("AGILE-OUTGOING-19-05-13", "E-1R-AGILE-OUTGOING-19-05-13-K"),
+    "import_a": ("AGILE-18-02-21", "E-1R-AGILE-18-02-21-A"),
+    "import_c": ("AGILE-18-02-21", "E-1R-AGILE-18-02-21-C"),
+}
+
+# Starting states of the HA entities the apps read
+DEFAULT_STATES = {
+    "input_datetime.tesla_start_time": "00:00:00",
+    "input_datetime.tesla_stop_time": "08:00:00",
+    "input_datetime.wh_start_time": "00:00:00",
+    "input_datetime.wh_stop_time": "08:00:00",
+    "input_number.tesla_min_slots": "4",
+    "input_number.wh_min_slots": "4",
+    "input_number.tesla_threshold": "10",
+    "input_number.wh_threshold": "9",
+    "input_boolean.tesla_override": "off",
+    "input_boolean.wh_override": "off",
+    "device_tracker.kod_location_tracker": "home",
+    "binary_sensor.kod_charger_sensor": "on",
+    "sensor.kod_battery_sensor": "40",
+    "input_number.tesla_target_soc": "80",
+    "input_datetime.tesla_departure_time": "07:30:00",
+    "switch.kod_charger_switch": "off",
+    "switch.bf9dc8fccf7de43ea4lx7j": "off",
+}
+
+
+def Milliseconds(seconds, width = 9):
+    return ("%" + str(width) + ".2f") % (seconds * 1000)
+
+
+class Timer:
+
+    # Context manager timing a block, in seconds
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        self.elapsed = time.perf_counter() - self.start
+
+
+def BenchStages(server, output):
+
+    url = server.URL(*BENCH_TARIFFS["import"])
+    output("Pipeline stages (ms)")
+    output("   days   slots  pages   fetch   parse   store  select  shared  publish  HA calls")
+    for days in HORIZONS:
+        from_slot = SlotFromDatetime(datetime.now(timezone.utc)) - 2
+        to_slot = from_slot + days * 48
+
+        async def Fetch():
+            octopus = OctopusAPI.OctopusClient()
+            try:
+                return await octopus.GetRates(url, DatetimeFromSlot(from_slot).isoformat() + "Z",
+                                              DatetimeFromSlot(to_slot).isoformat() + "Z")
+            finally:
+                await octopus.Close()
+
+        with Timer() as fetch:
+            records, stats = asyncio.run(Fetch())
+
+        with Timer() as parse:
+            rates = list(OctopusAPI.RatesFromRecords(records, from_slot, to_slot))
+
+        with tempfile.TemporaryDirectory() as directory:
+            store = RateStore(os.path.join(directory, "rates.db"))
+            with Timer() as store_time:
+                store.Store(rates)
+                rates = store.Prices(from_slot, to_slot)
+            store.Close()
+
+        # One overnight load per day of the horizon
+        with Timer() as select:
+            loads = []
+            for day in range(days):
+                midnight = from_slot - from_slot % 48 + 48 * (day + 1)
+                loads.append(Load("load" + str(day), midnight, midnight + 16, 4))
+            AllocateSlots(rates, loads)
+
+        # Two overnight loads per day, sharing a supply with room for only one of them at a time
+        with Timer() as shared:
+            shared_loads = []
+            for day in range(days):
+                midnight = from_slot - from_slot % 48 + 48 * (day + 1)
+                shared_loads.append(Load("car" + str(day), midnight, midnight + 16, 6, kw = 7))
+                shared_loads.append(Load("wh" + str(day), midnight, midnight + 16, 4, kw = 3))
+            AllocateSlots(rates, shared_loads, 9)
+
+        hass = FakeHass.HomeAssistant()
+        app = FakeHass.Hass(hass, "publish")
+        with Timer() as publish:
+            for load in loads:
+                app.set_state("input_number." + load.name + "_threshold", state = load.Threshold(Octopus.HEADROOM, 9))
+            app.set_state("sensor.octopus_rates", state = len(rates), attributes = {"prices": [[slot, price] for (slot, price) in rates]})
+        hass.Close()
+
+        output("%7d %7d %6d %s %s %s %s %s %s %9d" % (days, len(rates), stats["pages"], Milliseconds(fetch.elapsed, 7),
+               Milliseconds(parse.elapsed, 7), Milliseconds(store_time.elapsed, 7), Milliseconds(select.elapsed, 7),
+               Milliseconds(shared.elapsed, 7), Milliseconds(publish.elapsed, 8), hass.Count()))
+
+
+def BenchApps(server, output):
+
+    tariffs = { name: { "url": server.URL(product, tariff) } for (name, (product, tariff)) in BENCH_TARIFFS.items() }
+
+    output("Apps end to end (ms), " + str(len(tariffs)) + " tariffs")
+    output("   run                              time  HA calls  API requests")
+    with tempfile.TemporaryDirectory() as directory:
+        hass = FakeHass.HomeAssistant(DEFAULT_STATES)
+        args = { "rate_store": os.path.join(directory, "rates.db"), "tariffs": tariffs,
+                 "snapshot": os.path.join(directory, "snapshot.json") }
+        octopus = Octopus.OctopusAnalysis(hass, "OctopusAnalysis", args)
+        tesla = Tesla.TeslaSwitching(hass, "TeslaSwitching")
+        immersion = Immersion.ImmersionSwitching(hass, "ImmersionSwitching")
+
+        def Run(name, action):
+            hass.ResetCounts()
+            requests = server.requests
+            with Timer() as run:
+                action()
+            output("   %-28s %s %9d %13d" % (name, Milliseconds(run.elapsed), hass.Count(), server.requests - requests))
+
+        Run("OctopusAnalysis.initialize", octopus.initialize)
+        Run("Refresh, empty store", lambda: (hass.Call(octopus.Refresh, {}), hass.Run()))
+        Run("Refresh, warm store", lambda: (hass.Call(octopus.Refresh, {}), hass.Run()))
+        Run("Analyse, nothing changed", lambda: octopus.Analyse({}))
+        Run("Analyse, settings changed", lambda: (hass.SetState("input_number.tesla_min_slots", "6"), hass.Run()))
+
+        # A restart, starting from the snapshot the runs above saved, before any refresh
+        restarted = Octopus.OctopusAnalysis(hass, "Restarted", args)
+        Run("initialize from snapshot", restarted.initialize)
+        hass.Call(restarted.terminate)
+        for (handle, (when, callback, kwargs)) in list(hass.timers.items()):
+            if getattr(callback, "__self__", None) is restarted:
+                hass.timers.pop(handle)
+
+        for (app, name) in ((tesla, "TeslaSwitching"), (immersion, "ImmersionSwitching")):
+            Run(name + ".initialize", lambda: (app.initialize(), hass.Run()))
+            Run(name + ".Plan", lambda: (app.Plan(), hass.Run()))
+            output("   %-28s %s" % ("  switch calls", str(app.switches.Counters())))
+
+        # Plugging the car in plans its charge from the prices already held, without the API
+        hass.SetState("binary_sensor.kod_charger_sensor", "off")
+        hass.Run(time.time() + 2)
+        Run("TeslaSwitching, plugged in", lambda: (hass.SetState("binary_sensor.kod_charger_sensor", "on"), hass.Run()))
+        plan = hass.states["sensor.tesla_charge_plan"]["attributes"]
+        output("   %-28s %s" % ("  charge plan", str(plan["slots_needed"]) + " slots planned in " + str(plan["latency_ms"]) + "ms"))
+
+        prices = [[slot, price] for (slot, price) in octopus.price_timeline.Rates(octopus.price_timeline.first_slot,
+                                                                                   octopus.price_timeline.end_slot)]
+
+        hass.Call(octopus.terminate)
+        hass.Close()
+
+    BenchDevices(prices, output)
+
+
+def BenchDevices(prices, output):
+
+    # DEVICES devices, half on each of the two thresholds, switched by one LoadSwitching app and by
+    #   one app each, then all planned again when the prices are republished.  The switches start on,
+    #   so that the first plan switches most of them off.
+    devices = {}
+    for i in range(DEVICES):
+        prefix = "tesla" if i % 2 == 0 else "wh"
+        devices["load" + str(i)] = { "switch": "switch.bench_load_" + str(i), "threshold": "input_number." + prefix + "_threshold",
+                                     "start_time": "input_datetime." + prefix + "_start_time",
+                                     "stop_time": "input_datetime." + prefix + "_stop_time" }
+
+    output(str(DEVICES) + " devices, one app or one app each (ms)")
+    output("   run                              time  HA calls  callbacks  service calls")
+    for (name, apps) in (("1 app", [{ "devices": devices }]),
+                         (str(DEVICES) + " apps", [{ "devices": { device: config } } for (device, config) in devices.items()])):
+        states = dict(DEFAULT_STATES)
+        states.update({ config["switch"]: "on" for config in devices.values() })
+        hass = FakeHass.HomeAssistant(states)
+        hass.SetState("sensor.octopus_rates", len(prices), { "prices": prices })
+        instances = [LoadSwitching.LoadSwitching(hass, "LoadSwitching" + str(i), args) for (i, args) in enumerate(apps)]
+
+        for (run, action) in (("initialize", lambda: [app.initialize() for app in instances]),
+                              ("prices republished", lambda: hass.SetState("sensor.octopus_rates", len(prices) - 1,
+                                                                           { "prices": prices[1:] }))):
+            hass.ResetCounts()
+            with Timer() as elapsed:
+                action()
+                callbacks = hass.Run(time.time() + 2)      # past the debounce of the switching
+            service_calls = hass.calls["call_service"]
+            output("   %-28s %s %9d %10d %14d" % (name + ", " + run, Milliseconds(elapsed.elapsed), hass.Count(),
+                                                  callbacks, service_calls))
+        hass.Close()
+
+
+def BenchTimeline(output):
+
+    # Each query is repeated over ranges starting at every slot of the first week
+    slots = 365 * 48
+    prices = [MockPrice(slot) for slot in range(slots)]
+    with Timer() as build:
+        timeline = PriceTimeline(0, prices)
+    output("Price timeline, " + str(slots) + " slots (us per query)")
+    output("   built in " + Milliseconds(build.elapsed).strip() + "ms")
+    output("   query                          timeline     sorted")
+    starts = range(0, 7 * 48)
+    for (name, length, count) in (("Price", 1, None), ("Minimum, 16 slots", 16, None), ("Minimum, a week", 7 * 48, None),
+                                  ("Cheapest 4 of 16 slots", 16, 4), ("Cheapest 4 in a week", 7 * 48, 4),
+                                  ("Cheapest 48 in a week", 7 * 48, 48)):
+        with Timer() as query:
+            for start in starts:
+                if length == 1:
+                    timeline.Price(start)
+                elif count is None:
+                    timeline.Minimum(start, start + length)
+                else:
+                    timeline.Cheapest(count, start, start + length)
+        with Timer() as sort:
+            for start in starts:
+                sorted(timeline.Rates(start, start + length), key = lambda rate: (rate[1], rate[0]))[0:count or 1]
+        output("   %-28s %10.2f %10.2f" % (name, query.elapsed * 1e6 / len(starts), sort.elapsed * 1e6 / len(starts)))
+
+
+def BenchFailures(output):
+
+    # Retries against a slow, unreliable API
+    OctopusAPI.RETRY_BASE_DELAY = 0.05
+    server = MockOctopusServer(latency = 0.05, failure_rate = 0.3).Start()
+    url = server.URL(*BENCH_TARIFFS["import"])
+    from_slot = SlotFromDatetime(datetime.now(timezone.utc))
+
+    async def Fetch():
+        octopus = OctopusAPI.OctopusClient()
+        results = []
+        try:
+            for i in range(20):
+                try:
+                    records, stats = await octopus.GetRates(url, DatetimeFromSlot(from_slot).isoformat() + "Z",
+                                                            DatetimeFromSlot(from_slot + 52).isoformat() + "Z")
+                    results.append(stats["latency"])
+                except OctopusAPI.OctopusError:
+                    results.append(None)
+        finally:
+            await octopus.Close()
+        return results
+
+    results = asyncio.run(Fetch())
+    server.Stop()
+    latencies = sorted(latency for latency in results if latency is not None)
+    output("Unreliable API (50ms latency, 30% failures), 20 fetches")
+    output("   succeeded %d, requests %d, failed requests %d, median %sms, worst %sms" % (
+           len(latencies), server.requests, server.failures,
+           Milliseconds(latencies[len(latencies) // 2]).strip() if latencies else "-",
+           Milliseconds(latencies[-1]).strip() if latencies else "-"))
+
+
+def BenchTariffs(output):
+
+    # A day of prices for each tariff, from an API taking 50ms per request
+    server = MockOctopusServer(latency = 0.05).Start()
+    urls = [server.URL(product, tariff) for (product, tariff) in BENCH_TARIFFS.values()]
+    from_slot = SlotFromDatetime(datetime.now(timezone.utc))
+    period_from = DatetimeFromSlot(from_slot).isoformat() + "Z"
+    period_to = DatetimeFromSlot(from_slot + 48).isoformat() + "Z"
+
+    async def Fetch(together):
+        octopus = OctopusAPI.OctopusClient()
+        try:
+            if together:
+                await asyncio.gather(*[octopus.GetRates(url, period_from, period_to) for url in urls])
+            else:
+                for url in urls:
+                    await octopus.GetRates(url, period_from, period_to)
+        finally:
+            await octopus.Close()
+
+    output(str(len(urls)) + " tariffs from a slow API (50ms latency), a day each (ms)")
+    for (name, together) in (("one after another", False), ("all at once", True)):
+        with Timer() as fetch:
+            asyncio.run(Fetch(together))
+        output("   %-28s %s" % (name, Milliseconds(fetch.elapsed)))
+    server.Stop()
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description = "Benchmark the Octopus apps against a mock API and fake Home Assistant")
+    parser.add_argument("--output", help = "also write the results to this file")
+    args = parser.parse_args()
+
+    lines = []
+
+    def Output(line):
+        print(line)
+        lines.append(line)
+
+    server = MockOctopusServer().Start()
+    try:
+        BenchStages(server, Output)
+        Output("")
+        BenchApps(server, Output)
+    finally:
+        server.Stop()
+    Output("")
+    BenchTimeline(Output)
+    Output("")
+    BenchTariffs(Output)
+    Output("")
+    BenchFailures(Output)
+
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            f.write("\n".join(lines) + "\n")
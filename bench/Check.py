@@ -0,0 +1,228 @@
+import argparse
+import itertools
+import os
+import random
+import sys
+
+###############
+# Checks of the slot selection against brute force
+###############
+
+# Run from anywhere with:
+#
+#   python3 bench/Check.py
+#
+# The slot selection is done with algorithms that are quick but not obviously right, so this checks
+#   them against the slowest possible way of getting the same answer, trying every choice there is,
+#   over many small random cases.  Prices are whole numbers, with gaps, so that totals compare
+#   exactly and the missing prices are exercised.  Any case that doesn't match is printed, and the
+#   exit status is 1.  Run it after changing any of:
+#   - the "block" and "runs" modes of SlotAllocation.py, checked for the same number of slots at
+#     the same total price as the cheapest allowed choice;
+#   - the sharing of a site capacity in SlotAllocation.py.  This is a greedy allocation, so it isn't
+#     always the best there is, and is only checked for never going over the capacity, and for
+#     giving a load on its own, with room to run, the same slots as without a capacity.  How often
+#     it matches the best allocation is reported, for comparison with any change to it;
+#   - the Minimum and Cheapest queries of PriceTimeline.py, checked against sorting the prices in
+#     the range, with ties to the earlier slot.
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(os.path.dirname(BENCH_DIR), "appdaemon", "apps"))
+
+from SlotAllocation import Load, AllocateSlots, MODE_BLOCK, MODE_RUNS
+from PriceTimeline import PriceTimeline
+
+SHARED_CASES = 200
+
+CASES = 500
+FIRST_SLOT = 1000
+
+
+def RandomPrices(rng, length):
+
+    # Prices for length slots from FIRST_SLOT, as a dict of slot: price, with about one in six missing
+    return { slot: rng.randint(-5, 30) for slot in range(FIRST_SLOT, FIRST_SLOT + length) if rng.random() > 0.15 }
+
+
+def Runs(slots):
+
+    # The lengths of the runs of consecutive slots in a sorted list of slots
+    runs = []
+    for (i, slot) in enumerate(slots):
+        if i > 0 and slots[i - 1] == slot - 1:
+            runs[-1] = runs[-1] + 1
+        else:
+            runs.append(1)
+    return runs
+
+
+def BruteBlock(prices, load):
+
+    # (length, total) of the cheapest run of consecutive priced slots in the window, of the length
+    #   wanted or, if there is none that long, the longest there is
+    for length in range(min(load.slots_wanted, load.window_to - load.window_from), 0, -1):
+        totals = [sum(prices[slot] for slot in range(first, first + length))
+                  for first in range(load.window_from, load.window_to - length + 1)
+                  if all(slot in prices for slot in range(first, first + length))]
+        if len(totals) > 0:
+            return (length, min(totals))
+    return (0, 0)
+
+
+def BruteRuns(prices, load):
+
+    # (number of slots, total) of the choice of priced slots in the window with as many slots as
+    #   possible, up to the number wanted, then the lowest total, where every run is at least
+    #   min_run long and there are at most max_starts runs
+    priced = [slot for slot in range(load.window_from, load.window_to) if slot in prices]
+    best = (0, 0)
+    for count in range(1, min(load.slots_wanted, len(priced)) + 1):
+        for slots in itertools.combinations(priced, count):
+            runs = Runs(slots)
+            if min(runs) < load.min_run or (load.max_starts is not None and len(runs) > load.max_starts):
+                continue
+            total = sum(prices[slot] for slot in slots)
+            if count > best[0] or (count == best[0] and total < best[1]):
+                best = (count, total)
+    return best
+
+
+def CheckModes(rng, output):
+
+    # The block and runs modes, each on their own, against the brute force choice
+    failures = 0
+    for mode in (MODE_BLOCK, MODE_RUNS):
+        mode_failures = 0
+        for case in range(CASES):
+            length = rng.randint(1, 12)
+            prices = RandomPrices(rng, length)
+            window_from = FIRST_SLOT + rng.randint(0, length - 1)
+            window_to = rng.randint(window_from + 1, FIRST_SLOT + length)
+            load = Load("load", window_from, window_to, rng.randint(1, 8), mode,
+                        rng.randint(1, 3), rng.choice([None, 1, 2, 3]))
+            AllocateSlots(list(prices.items()), [load])
+            slots = sorted(slot for (slot, price) in load.allocation)
+            got = (len(slots), sum(price for (slot, price) in load.allocation))
+            if mode == MODE_BLOCK:
+                wanted = BruteBlock(prices, load)
+                valid = len(Runs(slots)) <= 1
+            else:
+                wanted = BruteRuns(prices, load)
+                runs = Runs(slots)
+                valid = len(runs) == 0 or (min(runs) >= load.min_run and (load.max_starts is None or len(runs) <= load.max_starts))
+            valid = valid and all(window_from <= slot < window_to and slot in prices for slot in slots)
+            if got != wanted or not valid:
+                mode_failures = mode_failures + 1
+                output("   " + mode + " mismatch: prices " + str(prices) + ", window " + str((window_from, window_to)) +
+                       ", wanted " + str(load.slots_wanted) + ", min_run " + str(load.min_run) + ", max_starts " +
+                       str(load.max_starts) + ": got " + str(slots) + " " + str(got) + ", brute force " + str(wanted))
+        output("   %-28s %s" % (mode + ", " + str(CASES) + " cases", "ok" if mode_failures == 0 else "FAILED"))
+        failures = failures + mode_failures
+    return failures
+
+
+def Choices(prices, load):
+
+    # Every choice of priced slots in the load's window, up to the number wanted, as tuples
+    priced = [slot for slot in range(load.window_from, load.window_to) if slot in prices]
+    return [slots for count in range(min(load.slots_wanted, len(priced)) + 1) for slots in itertools.combinations(priced, count)]
+
+
+def BruteShared(prices, loads, capacity):
+
+    # (slots short of those wanted, total) of the best allocation of the loads within the capacity:
+    #   the fewest slots short, then the lowest total
+    best = None
+    for choice in itertools.product(*[Choices(prices, load) for load in loads]):
+        used = {}
+        for (load, slots) in zip(loads, choice):
+            for slot in slots:
+                used[slot] = used.get(slot, 0) + load.kw
+        if any(kw > capacity for kw in used.values()):
+            continue
+        score = (sum(load.slots_wanted - len(slots) for (load, slots) in zip(loads, choice)),
+                 sum(prices[slot] for slots in choice for slot in slots))
+        if best is None or score < best:
+            best = score
+    return best
+
+
+def CheckShared(rng, output):
+
+    # Loads sharing a site capacity: never over it, each in its own window, and a load on its own
+    #   with room to run given the same slots as without a capacity
+    failures = 0
+    optimal = 0
+    for case in range(SHARED_CASES):
+        length = rng.randint(1, 7)
+        prices = RandomPrices(rng, length)
+        capacity = rng.randint(2, 5)
+        loads = []
+        for i in range(rng.randint(1, 3)):
+            window_from = FIRST_SLOT + rng.randint(0, length - 1)
+            loads.append(Load("load" + str(i), window_from, rng.randint(window_from + 1, FIRST_SLOT + length),
+                              rng.randint(1, 4), kw = rng.randint(1, 3)))
+        AllocateSlots(list(prices.items()), loads, capacity)
+        used = {}
+        valid = True
+        for load in loads:
+            slots = [slot for (slot, price) in load.allocation]
+            valid = valid and len(slots) == len(set(slots)) and len(slots) <= load.slots_wanted
+            valid = valid and all(load.window_from <= slot < load.window_to and slot in prices for slot in slots)
+            for slot in slots:
+                used[slot] = used.get(slot, 0) + load.kw
+        valid = valid and all(kw <= capacity for kw in used.values())
+        if len(loads) == 1 and loads[0].kw <= capacity:
+            alone = Load("alone", loads[0].window_from, loads[0].window_to, loads[0].slots_wanted)
+            AllocateSlots(list(prices.items()), [alone])
+            valid = valid and sorted(loads[0].allocation) == sorted(alone.allocation)
+        score = (sum(load.slots_wanted - len(load.allocation) for load in loads),
+                 sum(price for load in loads for (slot, price) in load.allocation))
+        if score == BruteShared(prices, loads, capacity):
+            optimal = optimal + 1
+        if not valid:
+            failures = failures + 1
+            output("   shared allocation invalid: prices " + str(prices) + ", capacity " + str(capacity) + ", loads " +
+                   str([(load.window_from, load.window_to, load.slots_wanted, load.kw, load.allocation) for load in loads]))
+    output("   %-28s %s" % ("shared, " + str(SHARED_CASES) + " cases", "ok" if failures == 0 else "FAILED"))
+    output("   %-28s %d%%" % ("  best allocation found", round(optimal * 100 / SHARED_CASES)))
+    return failures
+
+
+def CheckTimeline(rng, output):
+
+    # Minimum and Cheapest over random ranges, which may run off either end of the prices, against
+    #   the prices in the range sorted by price then slot
+    failures = 0
+    for case in range(CASES):
+        length = rng.randint(0, 100)
+        prices = RandomPrices(rng, length)
+        timeline = PriceTimeline(FIRST_SLOT, [prices.get(slot) for slot in range(FIRST_SLOT, FIRST_SLOT + length)])
+        from_slot = FIRST_SLOT + rng.randint(-5, length + 5)
+        to_slot = from_slot + rng.randint(0, length + 5)
+        exclude = set(rng.sample(range(FIRST_SLOT, FIRST_SLOT + length), length // 4)) if rng.random() < 0.5 else None
+        count = rng.randint(0, 30)
+        ranked = sorted((price, slot) for (slot, price) in prices.items() if from_slot <= slot < to_slot)
+        minimum = (ranked[0][1], ranked[0][0]) if len(ranked) > 0 else None
+        cheapest = [(slot, price) for (price, slot) in ranked if exclude is None or slot not in exclude][:count]
+        if timeline.Minimum(from_slot, to_slot) != minimum or timeline.Cheapest(count, from_slot, to_slot, exclude) != cheapest:
+            failures = failures + 1
+            output("   timeline mismatch: prices " + str(prices) + ", range " + str((from_slot, to_slot)) + ", count " +
+                   str(count) + ", exclude " + str(exclude) + ": got " + str(timeline.Cheapest(count, from_slot, to_slot, exclude)) +
+                   ", sorted " + str(cheapest))
+    output("   %-28s %s" % ("timeline, " + str(CASES) + " cases", "ok" if failures == 0 else "FAILED"))
+    return failures
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description = "Check the slot selection against brute force")
+    parser.add_argument("--seed", type = int, default = 1, help = "seed for the random cases")
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    print("Slot allocation against brute force")
+    failures = CheckModes(rng, print) + CheckShared(rng, print)
+    print("")
+    print("Price timeline against sorting")
+    failures = failures + CheckTimeline(rng, print)
+    sys.exit(1 if failures > 0 else 0)
@@ -0,0 +1,211 @@
+import asyncio
+import collections
+import functools
+import itertools
+import time
+
+###############
+# In-memory stand-in for the parts of hassapi.Hass used by the apps
+###############
+
+# Lets the apps run without Home Assistant or AppDaemon, for benchmarking.  A HomeAssistant object
+#   holds the entity states shared by all the apps, and counts every call the apps make to it.
+#   Like AppDaemon, API calls made from inside an async callback return an awaitable, and calls made
+#   from ordinary callbacks return their result directly.
+#
+# Callbacks aren't run straight away, but queued, as AppDaemon would hand them to a worker thread.
+#   HomeAssistant.Run runs them, along with any timers due.  Time doesn't pass by itself: timers set
+#   with run_in and no delay run on the next Run, others, like those set with run_at, when Run is
+#   given a time at or after theirs.
+
+
+class HomeAssistant:
+
+
+    def __init__(self, states = None, time_zone = "Europe/London"):
+
+        self.time_zone = time_zone
+        self.states = {}
+        for (entity, state) in (states or {}).items():
+            self.states[entity] = { "state": state, "attributes": {} }
+        self.listeners = []
+        self.timers = {}
+        self.queue = collections.deque()
+        self.apps = {}
+        self.handles = itertools.count(1)
+        self.calls = collections.Counter()
+        self.call_time = collections.Counter()
+        self.loop = asyncio.new_event_loop()
+
+
+    def Close(self):
+        self.loop.close()
+
+
+    def Count(self):
+
+        # Total number of HA calls made so far
+        return sum(self.calls.values())
+
+
+    def ResetCounts(self):
+        self.calls.clear()
+        self.call_time.clear()
+
+
+    def SetState(self, entity, state, attributes = None):
+
+        # Change an entity, as HA would, and queue the callbacks of any listeners it affects
+        old = self.states.get(entity, { "state": None, "attributes": {} })
+        new = { "state": state, "attributes": dict(old["attributes"]) }
+        new["attributes"].update(attributes or {})
+        self.states[entity] = new
+        for (callback, listen_entity, attribute, want, kwargs) in self.listeners:
+            if listen_entity != entity:
+                continue
+            if attribute is None:
+                old_value, new_value = old["state"], new["state"]
+            else:
+                old_value, new_value = old["attributes"].get(attribute), new["attributes"].get(attribute)
+            if old_value != new_value and (want is None or want == new_value):
+                self.queue.append((callback, (entity, attribute, old_value, new_value, kwargs)))
+
+
+    def Call(self, callback, *args):
+
+        if asyncio.iscoroutinefunction(callback):
+            return self.loop.run_until_complete(callback(*args))
+        return callback(*args)
+
+
+    def Run(self, until = None):
+
+        # Run queued callbacks and due timers until there is nothing left to do.  Returns the
+        #   number of callbacks run.
+        count = 0
+        while True:
+            if len(self.queue) > 0:
+                callback, args = self.queue.popleft()
+            else:
+                due = [(when, handle) for (handle, (when, callback, kwargs)) in self.timers.items()
+                       if when is None or (until is not None and when <= until)]
+                if len(due) == 0:
+                    return count
+                due.sort(key = lambda item: (item[0] is not None, item[0] or 0))
+                when, callback, kwargs = self.timers.pop(due[0][1])
+                args = (kwargs,)
+            self.Call(callback, *args)
+            count = count + 1
+
+
+def HassCall(method):
+
+    # Count and time each call, and make it awaitable when called from a coroutine
+    @functools.wraps(method)
+    def Wrapper(self, *args, **kwargs):
+        ts_start = time.perf_counter()
+        result = method(self, *args, **kwargs)
+        self.hass.calls[method.__name__] += 1
+        self.hass.call_time[method.__name__] += time.perf_counter() - ts_start
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            return result
+
+        async def Result():
+            return result
+        return Result()
+    return Wrapper
+
+
+class Hass:
+
+
+    def __init__(self, hass, name, args = None):
+
+        self.hass = hass
+        self.name = name
+        self.args = args or {}
+        self.logs = []
+        hass.apps[name] = self
+
+
+    def log(self, message, level = "INFO"):
+        self.logs.append(message)
+
+
+    def get_timezone(self):
+        return self.hass.time_zone
+
+
+    @HassCall
+    def get_state(self, entity, attribute = None):
+        if entity not in self.hass.states:
+            return None
+        if attribute == "all":
+            return self.hass.states[entity]
+        if attribute is not None:
+            return self.hass.states[entity]["attributes"].get(attribute)
+        return self.hass.states[entity]["state"]
+
+
+    @HassCall
+    def set_state(self, entity, state = None, attributes = None):
+        self.hass.SetState(entity, state, attributes)
+
+
+    @HassCall
+    def turn_on(self, entity):
+        self.hass.SetState(entity, "on")
+
+
+    @HassCall
+    def turn_off(self, entity):
+        self.hass.SetState(entity, "off")
+
+
+    @HassCall
+    def call_service(self, service, entity_id = None, **kwargs):
+        # Only the homeassistant/turn_on and turn_off services, for any number of entities
+        domain, action = service.split("/")
+        for entity in ([entity_id] if isinstance(entity_id, str) else entity_id or []):
+            self.hass.SetState(entity, "on" if action == "turn_on" else "off")
+
+
+    @HassCall
+    def listen_state(self, callback, entity, attribute = None, new = None, **kwargs):
+        self.hass.listeners.append((callback, entity, attribute, new, kwargs))
+
+
+    @HassCall
+    def run_in(self, callback, delay, **kwargs):
+        handle = next(self.hass.handles)
+        self.hass.timers[handle] = (None if delay == 0 else time.time() + delay, callback, kwargs)
+        return handle
+
+
+    @HassCall
+    def run_at(self, callback, when, **kwargs):
+        handle = next(self.hass.handles)
+        self.hass.timers[handle] = (when.timestamp(), callback, kwargs)
+        return handle
+
+
+    @HassCall
+    def run_hourly(self, callback, start, **kwargs):
+        # Hourly timers never come due by themselves; the benchmarks call the callbacks directly
+        return next(self.hass.handles)
+
+
+    @HassCall
+    def cancel_timer(self, handle):
+        self.hass.timers.pop(handle, None)
+
+
+    @HassCall
+    def get_app(self, name):
+        return self.hass.apps.get(name)
+
+
+    async def run_in_executor(self, func, *args, **kwargs):
+        return await self.hass.loop.run_in_executor(None, functools.partial(func, *args, **kwargs))
@@ -0,0 +1,134 @@
+import json
+import math
+import random
+import threading
+import time
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer
+from urllib.parse import urlencode
+from urllib.parse import urlsplit
+from urllib.parse import parse_qs
+from Slots import SLOT_LENGTH, SlotFromDatetime, DatetimeFromSlot
+
+###############
+# Local stand-in for the Octopus standard-unit-rates API
+###############
+
+# Serves Octopus-shaped pages of half-hourly prices for any product, tariff and period, newest first
+#   and paginated with "next" links as the real API does.  Prices are made up, but follow a daily
+#   shape with some noise, and are the same for a given slot every time they're asked for.  Each
+#   request can be delayed by a fixed latency, and a proportion of requests fail with HTTP 503.
+#   Export (Agile Outgoing) products follow the same shape at a lower level, as the real ones do.
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1500
+
+
+def MockPrice(slot, export = False):
+
+    # Cheap overnight, dear in the late afternoon peak, with a little noise on top
+    hour = (slot % 48) / 2
+    shape = 15 + 8 * math.sin((hour - 10) * math.pi / 12)
+    if 16 <= hour < 19:
+        shape = shape + 12
+    price = shape + random.Random(slot).uniform(-4, 4)
+    if export:
+        price = price * 0.6 - 1
+    return round(price, 2)
+
+
+class MockOctopusServer:
+
+
+    def __init__(self, latency = 0, failure_rate = 0, seed = 1):
+
+        # latency      - seconds to wait before answering each request
+        # failure_rate - proportion of requests answered with HTTP 503
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.random = random.Random(seed)
+        self.requests = 0
+        self.failures = 0
+        self.lock = threading.Lock()
+
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+
+            protocol_version = "HTTP/1.1"       # so that connections can be kept alive
+
+            def do_GET(self):
+                server.Handle(self)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.thread = threading.Thread(target = self.httpd.serve_forever, daemon = True)
+
+
+    def Start(self):
+        self.thread.start()
+        return self
+
+
+    def Stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+    def URL(self, product_code, tariff_code):
+        host, port = self.httpd.server_address
+        return ("http://" + host + ":" + str(port) + "/v1/products/" + product_code + "/electricity-tariffs/" +
+                tariff_code + "/standard-unit-rates/")
+
+
+    def Handle(self, request):
+
+        with self.lock:
+            self.requests = self.requests + 1
+            fail = self.random.random() < self.failure_rate
+            if fail:
+                self.failures = self.failures + 1
+        if self.latency > 0:
+            time.sleep(self.latency)
+        if fail:
+            request.send_response(503)
+            request.send_header("Content-Length", "0")
+            request.end_headers()
+            return
+
+        url = urlsplit(request.path)
+        query = { key: values[0] for (key, values) in parse_qs(url.query).items() }
+        from_slot = SlotFromDatetime(datetime.fromisoformat(query["period_from"].rstrip("Z")))
+        to_slot = SlotFromDatetime(datetime.fromisoformat(query["period_to"].rstrip("Z")))
+        page_size = min(int(query.get("page_size", DEFAULT_PAGE_SIZE)), MAX_PAGE_SIZE)
+        page = int(query.get("page", 1))
+        export = "OUTGOING" in url.path
+
+        count = max(0, to_slot - from_slot)
+        first = to_slot - 1 - (page - 1) * page_size
+        last = max(from_slot, first - page_size + 1)
+        results = []
+        for slot in range(first, last - 1, -1):
+            start_time = DatetimeFromSlot(slot)
+            price = MockPrice(slot, export)
+            results.append({
+                "value_exc_vat": round(price / 1.05, 4),
+                "value_inc_vat": price,
+                "valid_from": start_time.isoformat() + "Z",
+                "valid_to": (start_time + SLOT_LENGTH).isoformat() + "Z",
+            })
+
+        next_url = None
+        if page * page_size < count:
+            host, port = self.httpd.server_address
+            query["page"] = str(page + 1)
+            next_url = "http://" + host + ":" + str(port) + url.path + "?" + urlencode(query)
+
+        body = json.dumps({ "count": count, "next": next_url, "previous": None, "results": results }).encode()
+        request.send_response(200)
+        request.send_header("Content-Type", "application/json")
+        request.send_header("Content-Length", str(len(body)))
+        request.end_headers()
+        request.wfile.write(body)